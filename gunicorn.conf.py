@@ -0,0 +1,20 @@
+# gunicorn -c gunicorn.conf.py webapp:app
+import os
+
+bind = os.getenv('BIND', '0.0.0.0:5002')
+
+# One worker process: upload jobs, their progress (JOBS), each session's latest PDF and the pool of logged-in CRM
+# browsers all live in that process's memory, so a second worker would answer /status and /result polls for jobs
+# it never saw. Concurrency comes from threads instead - requests are short (the OCR + CRM work runs on
+# JOB_EXECUTOR) and mostly wait on I/O.
+workers = 1
+worker_class = 'gthread'
+threads = 4 * (os.cpu_count() or 1)
+
+# Large uploads are streamed to disk inside the request, which can take a while on slow links
+timeout = 600
+graceful_timeout = 30
+
+# No preload_app: webapp starts its log listener and thread pools at import time, and those threads would not
+# survive the fork into the worker
+preload_app = False
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+PDF page rendering for the OCR pipeline.
+Kept out of webapp.py because the render worker processes import it: they only need PyMuPDF/PDFium, OpenCV and
+numpy, not the Flask app, its loggers, thread pools and CRM browser pool.
+"""
+
+import cv2
+import fitz  # PyMuPDF
+import numpy as np
+try:
+    import pypdfium2 as pdfium  # optional, renders pages 2-3x faster than PyMuPDF
+except ImportError:
+    pdfium = None
+
+RENDER_BACKEND = 'PDFium' if pdfium is not None else 'PyMuPDF'
+
+def open_pdf(pdf_path):
+    """Open a PDF with PyMuPDF from a path or from the PDF's bytes"""
+    return fitz.open(stream=pdf_path, filetype='pdf') if isinstance(pdf_path, bytes) else fitz.open(pdf_path)
+
+def render_pdf_pages(pdf_path, page_numbers):
+    """Render the given pages at 2x zoom, returned as BGR numpy arrays ready for OpenCV. Runs in the render
+    worker processes, which reopen the PDF themselves because PyMuPDF documents can't be pickled"""
+    if pdfium is not None:
+        return _render_pdf_pages_pdfium(pdf_path, page_numbers)
+    doc = open_pdf(pdf_path)
+    try:
+        mat = fitz.Matrix(2.0, 2.0)  # 2x zoom for better quality
+        images = []
+        for page_num in page_numbers:
+            # Wrap the pixmap samples directly instead of encoding to PPM and decoding through PIL
+            pix = doc.load_page(page_num).get_pixmap(matrix=mat, colorspace=fitz.csRGB, alpha=False)
+            rgb = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, 3)
+            images.append(cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR))
+        return images
+    finally:
+        doc.close()
+
+def _render_pdf_pages_pdfium(pdf_path, page_numbers):
+    """render_pdf_pages using PDFium (pypdfium2)"""
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        # PDFium renders in BGR order natively, so the bitmap is already in OpenCV's layout
+        return [pdf[page_num].render(scale=2.0).to_numpy().copy() for page_num in page_numbers]
+    finally:
+        pdf.close()
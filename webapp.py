@@ -4,76 +4,301 @@ Integrated Flask web server with OCR and CRM automation capabilities.
 Combines image processing, text extraction, and CRM automation in one application.
 """
 
-from flask import Flask, render_template, request, redirect, url_for, flash, send_file, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, send_file, jsonify, session
+from flask.json.provider import DefaultJSONProvider
+import hashlib
+import io
 import os
-import uuid
-import sys
-import json
+import re
+import sqlite3
+import secrets
+import orjson
+import logging
+from logging.handlers import QueueHandler, QueueListener
 import time
-import argparse
+import atexit
+import queue
+import threading
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import multiprocessing
 import cv2
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import base64
 from matplotlib import pyplot as plt
 from dotenv import load_dotenv
 from openai import OpenAI
 import fitz  # PyMuPDF
-from pdf2image import convert_from_path
-from PIL import Image
+from pdf2image import convert_from_path, convert_from_bytes
+from pdf_render import RENDER_BACKEND, open_pdf, render_pdf_pages
 import numpy as np
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
+from selenium.common.exceptions import TimeoutException
 from webdriver_manager.chrome import ChromeDriverManager
 from selenium.webdriver.chrome.service import Service
-from bs4 import BeautifulSoup
+from lxml import etree
+try:
+    # optional, streams large uploads straight to disk instead of Werkzeug buffering them first
+    from streaming_form_data import StreamingFormDataParser
+    from streaming_form_data.targets import FileTarget
+except ImportError:
+    StreamingFormDataParser = None
 
 UPLOAD_FOLDER = 'uploads'
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'tiff', 'bmp', 'gif', 'pdf'}
+ALLOWED_EXTENSIONS = frozenset({'png', 'jpg', 'jpeg', 'tiff', 'bmp', 'gif', 'pdf'})
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson, so request.get_json() and jsonify() (the edited result table sent to
+    /generate_annotated_pdf can be large) are parsed and serialized in C"""
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.secret_key = 'supersecret'  # change in production
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+# Behind Apache/lighttpd (or nginx with X-Sendfile support), set USE_X_SENDFILE=1 so downloads are sent by the
+# web server with sendfile() instead of being streamed through a Python worker. Off by default: without such a
+# proxy the response body would be empty.
+app.config['USE_X_SENDFILE'] = bool(os.getenv('USE_X_SENDFILE'))
+# Compiled templates are kept instead of every render stat()ing the file to see if it changed (except under FLASK_DEBUG=1)
+app.config['TEMPLATES_AUTO_RELOAD'] = os.getenv('FLASK_DEBUG') == '1'
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# Uploads below this size are OCR'd from memory instead of being written out and read back
+IN_MEMORY_UPLOAD_LIMIT = 8 << 20  # bytes
+UPLOAD_CHUNK_SIZE = 64 << 10  # bytes read from the request body at a time when streaming an upload to disk
+
+# Log records are handed to a background listener thread so writing to the terminal never blocks
+# the browser automation. Set AUTOMATE_DEBUG=1 to also see the step-by-step CRM details.
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG if os.getenv('AUTOMATE_DEBUG') else logging.INFO)
+logger.propagate = False
+_log_queue = queue.SimpleQueue()
+logger.addHandler(QueueHandler(_log_queue))
+_log_listener = QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+# The CRM automation logs through its own child logger, so CRM_LOG_LEVEL (e.g. DEBUG or WARNING) can turn
+# its per-step output up or down without touching the rest of the app. Unset: same level as the app.
+crm_logger = logger.getChild('crm')
+CRM_LOG_LEVEL = os.getenv('CRM_LOG_LEVEL', '').strip().upper()
+if CRM_LOG_LEVEL in logging.getLevelNamesMapping():
+    crm_logger.setLevel(CRM_LOG_LEVEL)
+elif CRM_LOG_LEVEL:
+    logger.warning(f"⚠️ Unknown CRM_LOG_LEVEL {CRM_LOG_LEVEL!r}, CRM logging stays at the app's level")
+
 def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    _, dot, ext = filename.rpartition('.')
+    return bool(dot) and ext.lower() in ALLOWED_EXTENSIONS
+
+if StreamingFormDataParser is not None:
+    class _UploadTarget(FileTarget):
+        """Writes an uploaded file part into UPLOAD_FOLDER as <random hex>_<client filename> while it arrives.
+        Parts without an allowed filename are read but not written."""
+
+        def __init__(self):
+            super().__init__('')
+            self.upload_name = None
+
+        def on_start(self):
+            if self.multipart_filename and allowed_file(self.multipart_filename):
+                self.upload_name = f"{secrets.token_hex(8)}_{self.multipart_filename}"
+                self.filename = os.path.join(UPLOAD_FOLDER, self.upload_name)
+                super().on_start()
+
+def _stream_upload(field='file'):
+    """Parse the multipart request body chunk by chunk, writing the file in `field` straight to UPLOAD_FOLDER.
+    Bypasses request.files, so the upload is never buffered in memory or a temp file first. Returns the target:
+    multipart_filename is None if the field was missing, upload_name/filename are set only if it was written."""
+    target = _UploadTarget()
+    parser = StreamingFormDataParser(headers=request.headers)
+    parser.register(field, target)
+    while chunk := request.stream.read(UPLOAD_CHUNK_SIZE):
+        parser.data_received(chunk)
+    return target
 
 # ===============================
 # IMAGE PROCESSING & OCR FUNCTIONS
 # ===============================
 
-def preprocess_image(image):
-    """Preprocess image for better OCR accuracy"""
+load_dotenv()
+GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')  # read once at startup rather than on every Vision call
+
+OCR_MAX_CONCURRENCY = 8  # PDF pages preprocessed / Vision requests in flight at the same time
+VISION_BATCH_SIZE = 16  # images per images:annotate request (the API maximum)
+VISION_MAX_REQUEST_BYTES = 8 << 20  # base64 payload per request, below the API's 10 MB limit
+VISION_PNG_PARAMS = [cv2.IMWRITE_PNG_BILEVEL, 1]
+OCR_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'automate', 'ocr')  # OCR text by image hash
+PDF_RENDER_DPI = 200  # Vision reads printed invoice text just as well as at 300 dpi, with ~half the pixels
+OCR_MAX_DIMENSION = 2400  # longest image side sent to OCR (about A4 at 200 dpi); larger images are downscaled
+PDF_RENDER_PROCESSES = os.cpu_count() or 1  # worker processes rasterizing PDF pages
+PDF_RENDER_MIN_PAGES = 4  # smaller PDFs render faster in-process than via the worker pool
+NATIVE_TEXT_MIN_CHARS = 100  # a page's own text layer longer than this is used instead of OCR
+BLANK_PAGE_INK_RATIO = 0.002  # preprocessed pages with less dark-pixel coverage are not sent to OCR
+
+# Shared HTTP clients so batch processing reuses connections instead of reconnecting per call.
+# The Vision session keeps up to 16 pooled connections and retries transient failures (annotate is idempotent).
+vision_session = requests.Session()
+vision_session.mount("https://", HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=16,
+    max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=frozenset({'POST'})),
+))
+_grok_client = None
+_grok_client_lock = threading.Lock()
+
+GROK_MAX_CONCURRENCY = 6  # per-page Grok requests in flight for multi-page PDFs
+
+def get_grok_client(api_key):
+    """Return a shared xAI Grok client, creating it on first use"""
+    global _grok_client
+    with _grok_client_lock:
+        if _grok_client is None or _grok_client.api_key != api_key:
+            _grok_client = OpenAI(
+                api_key=api_key,
+                base_url="https://api.x.ai/v1",
+            )
+        return _grok_client
+
+def preprocess_image(image, denoise_level=1):
+    """Preprocess image for better OCR accuracy.
+    denoise_level: 0 = none, 1 = 3x3 median filter (fast), 2 = non-local means (slow, for very noisy scans)"""
+    # Downscale oversized scans first so every following pass touches fewer pixels
+    height, width = image.shape[:2]
+    scale = OCR_MAX_DIMENSION / max(height, width)
+    if scale < 1:
+        image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
     # Convert to grayscale
     gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
     
     # Apply thresholding to binarize
     _, thresh = cv2.threshold(gray, 150, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
     
-    # Denoise
-    denoised = cv2.fastNlMeansDenoising(thresh, None, 20, 7, 21)
-    
-    return denoised
+    # Denoise - on a binarized page a median filter removes the speckle at a fraction of NLM's cost
+    if denoise_level >= 2:
+        return cv2.fastNlMeansDenoising(thresh, None, 20, 7, 21)
+    if denoise_level == 1:
+        return cv2.medianBlur(thresh, 3)
+    return thresh
 
 def extract_text_with_api(image):
     """Extract text using Google Cloud Vision API"""
-    load_dotenv()
-    api_key = os.getenv('GOOGLE_API_KEY')
+    return extract_texts_with_api([image])[0]
+
+def extract_texts_with_api(images):
+    """Extract text from several images using Google Cloud Vision API.
+    Images are packed VISION_BATCH_SIZE to a request; returns one text per image, in order ("" on failure).
+    Results are cached on disk by image content, so pages seen before are not sent again"""
+    # Convert OpenCV images to PNG. Preprocessed pages are pure black/white, so they are stored as
+    # 1-bit PNGs - smaller and quicker to encode than 8-bit PNG, and far smaller than JPEG for text
+    encoded = [cv2.imencode('.png', image, VISION_PNG_PARAMS)[1].tobytes() for image in images]
+    cache_keys = [hashlib.blake2b(image_png, digest_size=16).hexdigest() for image_png in encoded]
+    texts = [_read_ocr_cache(key) for key in cache_keys]
+    # Uncached images, each distinct image only once (repeated pages share one OCR call)
+    missing = []
+    missing_keys = set()
+    for i, text in enumerate(texts):
+        if text is None and cache_keys[i] not in missing_keys:
+            missing_keys.add(cache_keys[i])
+            missing.append(i)
+    if not missing:
+        logger.info(f"♻️ OCR results for {len(texts)} image(s) loaded from cache")
+        return texts
+
+    api_key = GOOGLE_API_KEY
     if not api_key:
-        print("❌ GOOGLE_API_KEY not found in .env file")
-        print("💡 Please get an API key from: https://console.cloud.google.com/apis/credentials")
-        return ""
-
-    # Convert OpenCV image to base64
-    _, buffer = cv2.imencode('.png', image)
-    image_base64 = base64.b64encode(buffer).decode('utf-8')
+        logger.error("❌ GOOGLE_API_KEY not found in .env file")
+        logger.warning("💡 Please get an API key from: https://console.cloud.google.com/apis/credentials")
+        return [text or "" for text in texts]
+
+    # Split the uncached images into batches by image count and request size, keeping page order
+    batches = []
+    batch_bytes = 0
+    for i in missing:
+        image_base64 = base64.b64encode(encoded[i]).decode('utf-8')
+        if (not batches or len(batches[-1]) >= VISION_BATCH_SIZE
+                or batch_bytes + len(image_base64) > VISION_MAX_REQUEST_BYTES):
+            batches.append([])
+            batch_bytes = 0
+        batches[-1].append(image_base64)
+        batch_bytes += len(image_base64)
 
     # Prepare the request for Google Cloud Vision API
     url = f"https://vision.googleapis.com/v1/images:annotate?key={api_key}"
+    if len(batches) == 1:
+        ocr_texts = _annotate_images(url, batches[0])
+    else:
+        with ThreadPoolExecutor(max_workers=min(OCR_MAX_CONCURRENCY, len(batches))) as executor:
+            ocr_texts = [text for batch_texts in executor.map(lambda batch: _annotate_images(url, batch), batches)
+                         for text in batch_texts]
+
+    ocr_by_key = {cache_keys[i]: text for i, text in zip(missing, ocr_texts)}
+    for key, text in ocr_by_key.items():
+        if text:
+            _write_ocr_cache(key, text)
+    return [ocr_by_key[key] if text is None else text for key, text in zip(cache_keys, texts)]
+
+def _read_ocr_cache(key):
+    """Cached OCR text for an image hash, or None"""
+    try:
+        with open(os.path.join(OCR_CACHE_DIR, key), encoding='utf-8') as f:
+            return f.read()
+    except OSError:
+        return None
+
+def _write_ocr_cache(key, text):
+    """Store OCR text for an image hash (written to a temp file and renamed, so readers never see a partial file)"""
+    try:
+        os.makedirs(OCR_CACHE_DIR, exist_ok=True)
+        path = os.path.join(OCR_CACHE_DIR, key)
+        tmp_path = f"{path}.{secrets.token_hex(8)}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"⚠️ Could not write OCR cache: {e}")
+
+def prune_ocr_cache(max_age):
+    """Delete OCR cache entries written more than max_age seconds ago. Returns the number of entries deleted"""
+    cutoff = time.time() - max_age
+    removed = 0
+    try:
+        with os.scandir(OCR_CACHE_DIR) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file() and entry.stat().st_mtime < cutoff:
+                        os.unlink(entry.path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+    except FileNotFoundError:
+        return 0
+    if removed:
+        logger.info(f"🧹 Deleted {removed} OCR cache entries older than {max_age // 3600}h")
+    return removed
+
+def _annotate_images(url, images_base64):
+    """Send one Vision images:annotate request for a batch of base64 images, returning their texts in order"""
     headers = {
         'Content-Type': 'application/json'
     }
@@ -90,236 +315,321 @@ def extract_text_with_api(image):
                     }
                 ]
             }
+            for image_base64 in images_base64
         ]
     }
 
     try:
-        response = requests.post(url, headers=headers, json=data, timeout=30)
+        response = vision_session.post(url, headers=headers, json=data, timeout=30)
         response.raise_for_status()
 
-        result = response.json()
+        result = orjson.loads(response.content)
 
-        # Check if Vision API was successful
-        if 'responses' in result and len(result['responses']) > 0:
-            response_data = result['responses'][0]
+        # Check if Vision API was successful - responses come back in request order
+        responses = result.get('responses', [])
+        if len(responses) != len(images_base64):
+            logger.error("❌ Invalid response from Vision API")
+            return [""] * len(images_base64)
+
+        texts = []
+        for response_data in responses:
             if 'fullTextAnnotation' in response_data:
-                parsed_text = response_data['fullTextAnnotation']['text']
-                return parsed_text
+                texts.append(response_data['fullTextAnnotation']['text'])
             elif 'error' in response_data:
                 error_msg = response_data['error']['message']
-                print(f"❌ Vision API error: {error_msg}")
-                return ""
+                logger.error(f"❌ Vision API error: {error_msg}")
+                texts.append("")
             else:
-                print("❌ No text detected in the image")
-                return ""
-        else:
-            print("❌ Invalid response from Vision API")
-            return ""
+                logger.error("❌ No text detected in the image")
+                texts.append("")
+        return texts
 
     except requests.exceptions.RequestException as e:
-        print(f"❌ Error calling Vision API: {e}")
-        return ""
+        logger.error(f"❌ Error calling Vision API: {e}")
+        return [""] * len(images_base64)
     except Exception as e:
-        print(f"❌ Unexpected error: {e}")
-        return ""
+        logger.error(f"❌ Unexpected error: {e}")
+        return [""] * len(images_base64)
+
+# Lines worth sending to the LLM: payment fields, currencies and invoice-like numbers
+# (e.g. 25-AVS-RES-00109-RN)
+LLM_RELEVANT_LINE = re.compile(
+    r'date|amount|payee|payer|reference|invoice|total|HKD|USD|\$|\d{2}-[A-Z]+(?:-[A-Z]+)*-\d{3,}',
+    re.IGNORECASE
+)
+LLM_CONTEXT_LINES = 2
+LLM_COMPACT_MIN_LINES = 20
+
+def _compact_for_llm(text):
+    """Keep only invoice-relevant lines (plus surrounding context) to cut LLM prompt size"""
+    lines = text.split('\n')
+    # Short pages are cheap anyway - don't risk dropping names/addresses
+    if len(lines) < LLM_COMPACT_MIN_LINES:
+        return text
+
+    keep = set()
+    for i, line in enumerate(lines):
+        if LLM_RELEVANT_LINE.search(line):
+            keep.update(range(max(0, i - LLM_CONTEXT_LINES), min(len(lines), i + LLM_CONTEXT_LINES + 1)))
+
+    # Nothing recognisable on this page - send it as-is rather than dropping it
+    if not keep:
+        return text
+
+    return '\n'.join(lines[i] for i in sorted(keep))
 
 def is_pdf_file(file_path):
     """Check if the file is a PDF"""
     return file_path.lower().endswith('.pdf')
 
 def pdf_to_images(pdf_path):
-    """Convert PDF pages to images"""
+    """Convert PDF pages to images. pdf_path may also be the PDF's bytes"""
     try:
         # Convert PDF to images (one image per page)
-        images = convert_from_path(pdf_path, dpi=300)
+        if isinstance(pdf_path, bytes):
+            images = convert_from_bytes(pdf_path, dpi=PDF_RENDER_DPI, thread_count=PDF_RENDER_PROCESSES)
+        else:
+            images = convert_from_path(pdf_path, dpi=PDF_RENDER_DPI, thread_count=PDF_RENDER_PROCESSES)
         return images
     except Exception as e:
-        print(f"❌ Error converting PDF to images: {e}")
-        print("💡 Trying alternative method using PyMuPDF...")
+        logger.error(f"❌ Error converting PDF to images: {e}")
+        logger.warning("💡 Trying alternative method using PyMuPDF...")
         return pdf_to_images_alternative(pdf_path)
 
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+def _get_render_pool():
+    """Process pool used to rasterize large PDFs, started on first use"""
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            # spawn rather than fork: the web server process already runs threads (logging, CRM pool). Workers run
+            # pdf_render.render_pdf_pages, so they import that small module rather than this one
+            _render_pool = ProcessPoolExecutor(max_workers=PDF_RENDER_PROCESSES,
+                                               mp_context=multiprocessing.get_context('spawn'))
+            atexit.register(_render_pool.shutdown, wait=False)
+        return _render_pool
+
 def pdf_to_images_alternative(pdf_path):
-    """Alternative PDF to images conversion using PyMuPDF"""
+    """Alternative PDF to images conversion using PyMuPDF (or PDFium). Pages are returned as BGR numpy arrays"""
     try:
-        import fitz  # PyMuPDF
-        doc = fitz.open(pdf_path)
-        images = []
-        
-        for page_num in range(len(doc)):
-            page = doc.load_page(page_num)
-            # Render page to image
-            mat = fitz.Matrix(2.0, 2.0)  # 2x zoom for better quality
-            pix = page.get_pixmap(matrix=mat)
-            
-            # Convert to PIL Image
-            img_data = pix.tobytes("ppm")
-            from io import BytesIO
-            img = Image.open(BytesIO(img_data))
-            images.append(img)
-        
+        doc = open_pdf(pdf_path)
+        page_count = len(doc)
         doc.close()
-        print(f"✅ Successfully converted {len(images)} pages using PyMuPDF")
+
+        if PDF_RENDER_PROCESSES > 1 and page_count >= PDF_RENDER_MIN_PAGES:
+            # Rendering is CPU-bound and MuPDF serializes it within a process, so split the pages
+            # into one contiguous segment per worker process
+            segment_size = -(-page_count // PDF_RENDER_PROCESSES)
+            segments = [range(start, min(start + segment_size, page_count))
+                        for start in range(0, page_count, segment_size)]
+            rendered = _get_render_pool().map(render_pdf_pages, [pdf_path] * len(segments), segments)
+            images = [image for segment_images in rendered for image in segment_images]
+        else:
+            images = render_pdf_pages(pdf_path, range(page_count))
+
+        logger.info(f"✅ Successfully converted {len(images)} pages using {RENDER_BACKEND}")
         return images
     except Exception as e:
-        print(f"❌ Alternative PDF conversion also failed: {e}")
+        logger.error(f"❌ Alternative PDF conversion also failed: {e}")
+        return []
+
+def _preprocess_page(image):
+    """Preprocess a rendered PDF page for OCR. PIL pages (pdf2image) are converted to OpenCV format first,
+    numpy pages from pdf_to_images_alternative are already BGR"""
+    if isinstance(image, np.ndarray):
+        return preprocess_image(image)
+    cv_image = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
+    return preprocess_image(cv_image)
+
+def _native_page_texts(pdf_path):
+    """Text layer of each PDF page, None for pages that need OCR (scans, or too little text to trust)"""
+    try:
+        doc = open_pdf(pdf_path)
+    except Exception as e:
+        logger.warning(f"⚠️ Could not read the PDF text layer: {e}")
         return []
+    try:
+        page_texts = []
+        for page in doc:
+            text = page.get_text("text")
+            page_texts.append(text if len(text.strip()) > NATIVE_TEXT_MIN_CHARS else None)
+        return page_texts
+    finally:
+        doc.close()
+
+def _is_blank_page(preprocessed):
+    """True if a binarized page has (almost) no dark pixels, i.e. nothing for OCR to read"""
+    return np.count_nonzero(preprocessed < 128) / preprocessed.size <= BLANK_PAGE_INK_RATIO
 
 def extract_text_from_pdf_pages(pdf_path):
-    """Extract text from all pages of a PDF, separated by ------"""
-    images = pdf_to_images(pdf_path)
-    if not images:
-        return ""
-    
+    """Extract text from all pages of a PDF, one "PAGE n:" text per page (empty list if the PDF can't be read)"""
+    # Many invoices are generated PDFs with a text layer - those pages don't need rendering or OCR at all
+    page_texts = _native_page_texts(pdf_path)
+    if page_texts and None not in page_texts:
+        logger.info(f"📄 Using the text layer of {len(page_texts)} page(s), skipping OCR")
+    else:
+        images = pdf_to_images(pdf_path)
+        if not images:
+            return []
+        if len(page_texts) != len(images):
+            page_texts = [None] * len(images)
+        ocr_pages = [i for i, text in enumerate(page_texts) if text is None]
+
+        # Pages are preprocessed concurrently (OpenCV releases the GIL), then OCR'd in batched Vision requests.
+        # executor.map keeps the pages in order.
+        logger.info(f"📄 Processing {len(ocr_pages)} of {len(images)} page(s) with OCR...")
+        with ThreadPoolExecutor(max_workers=min(OCR_MAX_CONCURRENCY, len(ocr_pages))) as executor:
+            preprocessed_pages = list(executor.map(_preprocess_page, (images[i] for i in ocr_pages)))
+
+        # Empty pages (separator sheets, blank backs of scans) would only cost a Vision round trip
+        to_ocr = []
+        for i, preprocessed in zip(ocr_pages, preprocessed_pages):
+            if _is_blank_page(preprocessed):
+                logger.info(f"📄 Page {i+1} is blank, skipping OCR")
+                page_texts[i] = ""
+            else:
+                to_ocr.append((i, preprocessed))
+        if to_ocr:
+            for (i, _), text in zip(to_ocr, extract_texts_with_api([page for _, page in to_ocr])):
+                page_texts[i] = text
+
     all_text = []
-    for i, image in enumerate(images):
-        print(f"📄 Processing page {i+1}/{len(images)}...")
-        
-        # Convert PIL image to opencv format
-        cv_image = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
-        
-        # Preprocess and extract text
-        preprocessed = preprocess_image(cv_image)
-        page_text = extract_text_with_api(preprocessed)
-        
+    for i, page_text in enumerate(page_texts):
         # Print OCR results for this page
-        print(f"\n🔍 OCR Results for Page {i+1}:")
-        print("=" * 50)
-        print(page_text)
-        print("=" * 50)
-        
-        all_text.append(f"PAGE {i+1}:\n{page_text}")
+        logger.debug(f"\n🔍 OCR Results for Page {i+1}:\n{'=' * 50}\n{page_text}\n{'=' * 50}")
+
+        # Only the invoice-relevant part of each page goes to the LLM
+        all_text.append(f"PAGE {i+1}:\n{_compact_for_llm(page_text)}")
     
-    return "\n------\n".join(all_text)
+    return all_text
+
+# Approximate average character width, as a fraction of the font size, for common fonts
+CHAR_WIDTH_RATIO = {
+    'helv': 0.6,
+    'times': 0.55,
+    'cour': 0.6,
+    'cjk': 0.8,
+    'china-ss': 0.8,
+    'china-ts': 0.8
+}
 
 def calculate_text_dimensions(text, font_size, font_name='helv'):
     """Calculate approximate text dimensions for given text and font size"""
     try:
-        # Rough estimation based on font metrics
-        # These are approximations for common fonts
-        char_width_ratio = {
-            'helv': 0.6,
-            'times': 0.55,
-            'cour': 0.6,
-            'cjk': 0.8,
-            'china-ss': 0.8,
-            'china-ts': 0.8
-        }
-        
-        # Get character width multiplier
-        char_width = char_width_ratio.get(font_name, 0.6) * font_size
+        # Rough estimation based on font metrics (see CHAR_WIDTH_RATIO)
+        char_width = CHAR_WIDTH_RATIO.get(font_name, 0.6) * font_size
         line_height = font_size * 1.2  # Standard line height
         
         lines = text.split('\n')
-        max_line_width = max(len(line) for line in lines) if lines else 0
+        max_line_width = max(map(len, lines))  # split() always returns at least one line
         text_height = len(lines) * line_height
         text_width = max_line_width * char_width
         
         return text_width, text_height
     except Exception as e:
-        print(f"⚠️ Error calculating text dimensions: {e}")
+        logger.warning(f"⚠️ Error calculating text dimensions: {e}")
         # Return conservative estimates
         return 300, 200
 
-def find_available_spaces_on_page(doc, page_num, required_width=None, required_height=None):
-    """Find all available spaces on a PDF page, sorted by preference"""
+def get_occupied_areas(page):
+    """Bounding boxes of the text and image blocks on a page.
+    Only the block rectangles are extracted (same blocks as get_text("dict"), without the span details)"""
+    return [fitz.Rect(block[:4]) for block in page.get_text("blocks", flags=fitz.TEXTFLAGS_DICT)]
+
+# Candidate annotation areas, best first. Each coordinate is (fraction of the page size, offset in points),
+# e.g. (1, -10) is 10pt from the right/bottom edge
+POSITION_TEMPLATES = [
+    # Top right corner - various sizes
+    ((0.65, 0), (0, 30), (1, -10), (0, 300)),
+    ((0.7, 0), (0, 30), (1, -10), (0, 250)),
+    ((0.75, 0), (0, 30), (1, -10), (0, 200)),
+
+    # Bottom right corner - various sizes
+    ((0.65, 0), (1, -250), (1, -10), (1, -10)),
+    ((0.7, 0), (1, -200), (1, -10), (1, -10)),
+    ((0.75, 0), (1, -150), (1, -10), (1, -10)),
+
+    # Right margin - full height
+    ((0.75, 0), (0, 100), (1, -10), (1, -100)),
+    ((0.8, 0), (0, 50), (1, -10), (1, -50)),
+
+    # Bottom left corner
+    ((0, 10), (1, -250), (0.35, 0), (1, -10)),
+    ((0, 10), (1, -200), (0.3, 0), (1, -10)),
+
+    # Top left corner
+    ((0, 10), (0, 30), (0.35, 0), (0, 300)),
+    ((0, 10), (0, 30), (0.3, 0), (0, 250)),
+
+    # Full width bottom strip
+    ((0, 10), (1, -200), (1, -10), (1, -10)),
+    ((0, 10), (1, -150), (1, -10), (1, -10)),
+
+    # Left margin
+    ((0, 10), (0, 100), (0.25, 0), (1, -100)),
+]
+
+def find_available_spaces_on_page(page, required_width=None, required_height=None, occupied_areas=None):
+    """Find all available spaces on a PDF page (already loaded by the caller), sorted by preference.
+    occupied_areas can be passed in (see get_occupied_areas) to avoid extracting the page's blocks again"""
     try:
-        page = doc.load_page(page_num)
         rect = page.rect
         
         # Get existing text blocks to identify occupied areas
-        text_blocks = page.get_text("dict")["blocks"]
-        occupied_areas = []
-        
-        for block in text_blocks:
-            if "bbox" in block:
-                occupied_areas.append(fitz.Rect(block["bbox"]))
-        
-        # Define potential positions with different sizes
-        # Each position has a priority score (lower = better)
-        potential_positions = [
-            # Top right corner - various sizes
-            {'rect': fitz.Rect(rect.width * 0.65, 30, rect.width - 10, 300), 'priority': 1},
-            {'rect': fitz.Rect(rect.width * 0.7, 30, rect.width - 10, 250), 'priority': 2},
-            {'rect': fitz.Rect(rect.width * 0.75, 30, rect.width - 10, 200), 'priority': 3},
-            
-            # Bottom right corner - various sizes
-            {'rect': fitz.Rect(rect.width * 0.65, rect.height - 250, rect.width - 10, rect.height - 10), 'priority': 4},
-            {'rect': fitz.Rect(rect.width * 0.7, rect.height - 200, rect.width - 10, rect.height - 10), 'priority': 5},
-            {'rect': fitz.Rect(rect.width * 0.75, rect.height - 150, rect.width - 10, rect.height - 10), 'priority': 6},
-            
-            # Right margin - full height
-            {'rect': fitz.Rect(rect.width * 0.75, 100, rect.width - 10, rect.height - 100), 'priority': 7},
-            {'rect': fitz.Rect(rect.width * 0.8, 50, rect.width - 10, rect.height - 50), 'priority': 8},
-            
-            # Bottom left corner
-            {'rect': fitz.Rect(10, rect.height - 250, rect.width * 0.35, rect.height - 10), 'priority': 9},
-            {'rect': fitz.Rect(10, rect.height - 200, rect.width * 0.3, rect.height - 10), 'priority': 10},
-            
-            # Top left corner
-            {'rect': fitz.Rect(10, 30, rect.width * 0.35, 300), 'priority': 11},
-            {'rect': fitz.Rect(10, 30, rect.width * 0.3, 250), 'priority': 12},
-            
-            # Full width bottom strip
-            {'rect': fitz.Rect(10, rect.height - 200, rect.width - 10, rect.height - 10), 'priority': 13},
-            {'rect': fitz.Rect(10, rect.height - 150, rect.width - 10, rect.height - 10), 'priority': 14},
-            
-            # Left margin
-            {'rect': fitz.Rect(10, 100, rect.width * 0.25, rect.height - 100), 'priority': 15},
-        ]
-        
-        # Filter positions based on size requirements
-        if required_width or required_height:
-            filtered_positions = []
-            for pos in potential_positions:
-                pos_rect = pos['rect']
-                width_ok = not required_width or pos_rect.width >= required_width
-                height_ok = not required_height or pos_rect.height >= required_height
-                if width_ok and height_ok:
-                    filtered_positions.append(pos)
-            potential_positions = filtered_positions
+        if occupied_areas is None:
+            occupied_areas = get_occupied_areas(page)
         
-        # Check for overlaps and return available positions
+        # Candidate positions from POSITION_TEMPLATES, in priority order. Sizes are checked on plain floats
+        # and a fitz.Rect is only built for positions that pass the size filter
+        width, height = rect.width, rect.height
         available_positions = []
-        for pos in potential_positions:
-            pos_rect = pos['rect']
+        for (x0_frac, x0_off), (y0_frac, y0_off), (x1_frac, x1_off), (y1_frac, y1_off) in POSITION_TEMPLATES:
+            x0 = x0_frac * width + x0_off
+            y0 = y0_frac * height + y0_off
+            x1 = x1_frac * width + x1_off
+            y1 = y1_frac * height + y1_off
+            if (required_width and x1 - x0 < required_width) or (required_height and y1 - y0 < required_height):
+                continue
+
+            # Check for overlaps with the occupied areas
+            pos_rect = fitz.Rect(x0, y0, x1, y1)
+            pos_area = pos_rect.get_area()
             overlap_found = False
             
             for occupied in occupied_areas:
                 if pos_rect.intersects(occupied):
                     intersection = pos_rect & occupied
-                    overlap_ratio = intersection.get_area() / pos_rect.get_area()
+                    overlap_ratio = intersection.get_area() / pos_area
                     if overlap_ratio > 0.3:  # If more than 30% overlap
                         overlap_found = True
                         break
             
             if not overlap_found:
-                available_positions.append(pos)
-        
-        # Sort by priority (lower priority number = better position)
-        available_positions.sort(key=lambda x: x['priority'])
+                available_positions.append(pos_rect)
         
-        return [pos['rect'] for pos in available_positions]
+        return available_positions
         
     except Exception as e:
-        print(f"❌ Error finding available spaces on page {page_num}: {e}")
+        logger.error(f"❌ Error finding available spaces on page {page.number}: {e}")
         # Return a default position
         return [fitz.Rect(400, 400, 850, 750)]
 
-def find_blank_space_on_page(doc, page_num, required_width=None, required_height=None):
+def find_blank_space_on_page(page, required_width=None, required_height=None, occupied_areas=None):
     """Find a suitable blank space on a PDF page to insert text"""
-    available_spaces = find_available_spaces_on_page(doc, page_num, required_width, required_height)
+    available_spaces = find_available_spaces_on_page(page, required_width, required_height, occupied_areas)
     
     if available_spaces:
         return available_spaces[0]  # Return the best available space
     else:
         # Fallback to a default position if no space found
-        page = doc.load_page(page_num)
         rect = page.rect
         return fitz.Rect(rect.width * 0.65, rect.height - 200, rect.width - 10, rect.height - 10)
 
 def format_single_record_text(result, record_num, max_fields=15):
     """Format a single CRM record for display"""
-    record_text = f"Record {record_num}:\n"
+    parts = [f"Record {record_num}:\n"]
     
     # Get all non-internal fields (not starting with _) and display them
     displayed_fields = 0
@@ -342,7 +652,7 @@ def format_single_record_text(result, record_num, max_fields=15):
             if len(key) > 12:
                 short_key = key[:9] + "..."
             
-            record_text += f"• {short_key}: {clean_value}\n"
+            parts.append(f"• {short_key}: {clean_value}\n")
             displayed_fields += 1
     
     # Add source invoice info
@@ -350,28 +660,28 @@ def format_single_record_text(result, record_num, max_fields=15):
         orig_inv = str(result['_original_invoice_string'])
         if len(orig_inv) > 30:
             orig_inv = orig_inv[:27] + "..."
-        record_text += f"• Source Inv: {orig_inv}\n"
+        parts.append(f"• Source Inv: {orig_inv}\n")
     
-    return record_text
+    return "".join(parts)
 
 def format_extracted_info_text(parsed_info):
     """Format extracted page info for display"""
     if not parsed_info:
         return ""
     
-    info_text = "Extracted Info:\n"
+    parts = ["Extracted Info:\n"]
     if parsed_info.get('date'):
-        info_text += f"• Date: {parsed_info['date']}\n"
+        parts.append(f"• Date: {parsed_info['date']}\n")
     if parsed_info.get('amount'):
-        info_text += f"• Amount: {parsed_info['amount']}\n"
+        parts.append(f"• Amount: {parsed_info['amount']}\n")
     if parsed_info.get('payee'):
         payee = str(parsed_info['payee'])[:25] + "..." if len(str(parsed_info['payee'])) > 25 else str(parsed_info['payee'])
-        info_text += f"• Payee: {payee}\n"
+        parts.append(f"• Payee: {payee}\n")
     if parsed_info.get('reference'):
         ref = str(parsed_info['reference'])[:20] + "..." if len(str(parsed_info['reference'])) > 20 else str(parsed_info['reference'])
-        info_text += f"• Ref: {ref}\n"
+        parts.append(f"• Ref: {ref}\n")
     
-    return info_text
+    return "".join(parts)
 
 def insert_text_with_auto_resize(page, text, available_rect, font_size, font_type, text_color=(0, 0, 0)):
     """Insert text with automatic resizing if it doesn't fit"""
@@ -392,10 +702,15 @@ def insert_text_with_auto_resize(page, text, available_rect, font_size, font_typ
     if font_size > 6:
         font_sizes_to_try.append(font_size - 3)
     
+    # Background box and text are staged on one Shape and written to the page's content stream in a
+    # single commit. A textbox that doesn't fit is not written to the shape, so failed attempts add nothing.
+    shape = page.new_shape()
+
     # Add a white background rectangle with black border
     bg_rect = fitz.Rect(available_rect.x0 - 5, available_rect.y0 - 5, 
                       available_rect.x1 + 5, available_rect.y1 + 5)
-    page.draw_rect(bg_rect, color=(0, 0, 0), fill=(1, 1, 1), width=2)
+    shape.draw_rect(bg_rect)
+    shape.finish(color=(0, 0, 0), fill=(1, 1, 1), width=2)
     
     # Create inner text area
     inner_rect = fitz.Rect(available_rect.x0 + 5, available_rect.y0 + 5, 
@@ -405,45 +720,50 @@ def insert_text_with_auto_resize(page, text, available_rect, font_size, font_typ
         for font_name in fonts_to_try:
             try:
                 # Try to insert text with current font and size
-                inserted = page.insert_textbox(inner_rect, text, 
-                                             fontsize=current_font_size, 
-                                             color=text_color,
-                                             fontname=font_name,
-                                             align=0)
+                inserted = shape.insert_textbox(inner_rect, text, 
+                                              fontsize=current_font_size, 
+                                              color=text_color,
+                                              fontname=font_name,
+                                              align=0)
                 
                 if inserted >= 0:
-                    print(f"✅ Text inserted successfully with font: {font_name}, size: {current_font_size}")
+                    shape.commit()
+                    logger.debug(f"✅ Text inserted successfully with font: {font_name}, size: {current_font_size}")
                     return True, font_name, current_font_size
                     
             except Exception as e:
                 continue
     
     # If textbox method fails, try alternative point-based insertion
-    print("⚠️ Textbox insertion failed, trying point-based method...")
+    logger.warning("⚠️ Textbox insertion failed, trying point-based method...")
     for current_font_size in font_sizes_to_try:
         for font_name in fonts_to_try:
             try:
                 point = fitz.Point(inner_rect.x0, inner_rect.y0 + 15)
-                page.insert_text(point, text, fontsize=current_font_size, 
-                               color=text_color, fontname=font_name)
-                print(f"✅ Text inserted with alternative method - font: {font_name}, size: {current_font_size}")
+                shape.insert_text(point, text, fontsize=current_font_size, 
+                                color=text_color, fontname=font_name)
+                shape.commit()
+                logger.debug(f"✅ Text inserted with alternative method - font: {font_name}, size: {current_font_size}")
                 return True, font_name, current_font_size
             except Exception as e:
                 continue
     
-    print("❌ All text insertion methods failed")
+    shape.commit()  # keep the background box, as before
+    logger.error("❌ All text insertion methods failed")
     return False, None, None
 
-def create_annotated_pdf(original_pdf_path, parsed_info_list, all_crm_rows, output_path, invoice_to_page_mapping=None, font_size=6, font_type='auto'):
-    """Create an annotated PDF with CRM results overlaid on the original pages with auto-resizing and multi-area support"""
+def create_annotated_pdf(original_pdf_path, parsed_info_list, all_crm_rows, output_path, invoice_to_page_mapping=None, font_size=6, font_type='auto', save_mode='fast'):
+    """Create an annotated PDF with CRM results overlaid on the original pages with auto-resizing and multi-area support.
+    save_mode: 'fast' (light cleanup), 'compact' (full garbage collection, smallest file) or 'incremental'
+    (append the changes to the original file; only when output_path is the original PDF)"""
     try:
-        print(f"📖 Opening original PDF: {original_pdf_path}")
+        logger.info(f"📖 Opening original PDF: {original_pdf_path}")
         if not os.path.exists(original_pdf_path):
-            print(f"❌ Original PDF file does not exist: {original_pdf_path}")
+            logger.error(f"❌ Original PDF file does not exist: {original_pdf_path}")
             return False
             
         doc = fitz.open(original_pdf_path)
-        print(f"✅ Successfully opened PDF with {len(doc)} pages")
+        logger.info(f"✅ Successfully opened PDF with {len(doc)} pages")
         
         # Group CRM results by their page index
         crm_by_page = {}
@@ -455,35 +775,38 @@ def create_annotated_pdf(original_pdf_path, parsed_info_list, all_crm_rows, outp
         
         # Process each page
         for page_num in range(len(doc)):
-            page = doc.load_page(page_num)
-            
-            # Check if we have CRM results for this page
+            # Check if we have CRM results for this page (pages without results are never loaded)
             if page_num in crm_by_page:
+                page = doc.load_page(page_num)
                 crm_results = crm_by_page[page_num]
-                print(f"📄 Processing page {page_num + 1} with {len(crm_results)} CRM records")
+                logger.debug(f"📄 Processing page {page_num + 1} with {len(crm_results)} CRM records")
                 
                 # Get extracted page info
                 parsed_info = parsed_info_list[page_num] if page_num < len(parsed_info_list) else {}
+
+                # Occupied areas are extracted once per page; every box inserted below is added to the list
+                occupied_areas = get_occupied_areas(page)
+
+                # Record and page-info texts are formatted once and shared by both placement strategies
+                record_bodies = [format_single_record_text(result, i + 1) for i, result in enumerate(crm_results)]
+                extracted_text = format_extracted_info_text(parsed_info) if parsed_info else ""
                 
                 # If we have multiple records, try to fit them in separate areas
                 if len(crm_results) > 1:
-                    print(f"🔄 Multiple records detected, attempting to separate into different areas...")
+                    logger.debug(f"🔄 Multiple records detected, attempting to separate into different areas...")
                     
                     # Create individual texts for each record
                     record_texts = []
-                    for i, result in enumerate(crm_results):
+                    for i, record_body in enumerate(record_bodies):
                         header = f"CRM Results (Page {page_num + 1}) - Part {i + 1}:\n" + "=" * 30 + "\n"
-                        record_text = header + format_single_record_text(result, i + 1)
-                        record_texts.append(record_text)
+                        record_texts.append(header + record_body)
                     
                     # Add extracted info to the last record
-                    if parsed_info:
-                        extracted_text = format_extracted_info_text(parsed_info)
-                        if extracted_text:
-                            record_texts[-1] += "\n" + extracted_text
+                    if extracted_text:
+                        record_texts[-1] += "\n" + extracted_text
                     
                     # Try to place each record in a different area
-                    available_spaces = find_available_spaces_on_page(doc, page_num)
+                    available_spaces = find_available_spaces_on_page(page, occupied_areas=occupied_areas)
                     placed_successfully = True
                     
                     for i, record_text in enumerate(record_texts):
@@ -496,55 +819,53 @@ def create_annotated_pdf(original_pdf_path, parsed_info_list, all_crm_rows, outp
                             
                             # Check if the space is large enough, if not find a better one
                             if text_rect.width < req_width or text_rect.height < req_height:
-                                better_spaces = find_available_spaces_on_page(doc, page_num, req_width, req_height)
+                                better_spaces = find_available_spaces_on_page(page, req_width, req_height, occupied_areas)
                                 if better_spaces:
                                     text_rect = better_spaces[0]
                             
-                            print(f"📝 Placing record {i + 1} in area: {text_rect}")
+                            logger.debug(f"📝 Placing record {i + 1} in area: {text_rect}")
                             success, font_used, size_used = insert_text_with_auto_resize(
                                 page, record_text, text_rect, font_size, font_type
                             )
                             
                             if not success:
-                                print(f"⚠️ Failed to place record {i + 1} separately")
+                                logger.warning(f"⚠️ Failed to place record {i + 1} separately")
                                 placed_successfully = False
                                 break
+                            occupied_areas.append(text_rect)
                         else:
-                            print(f"⚠️ No available space for record {i + 1}")
+                            logger.warning(f"⚠️ No available space for record {i + 1}")
                             placed_successfully = False
                             break
                     
                     if placed_successfully:
-                        print(f"✅ Successfully placed all {len(crm_results)} records in separate areas")
+                        logger.debug(f"✅ Successfully placed all {len(crm_results)} records in separate areas")
                         continue
                     else:
-                        print(f"⚠️ Could not place all records separately, falling back to combined approach")
+                        logger.warning(f"⚠️ Could not place all records separately, falling back to combined approach")
                 
                 # Fallback: Combine all records in a single area (original approach but with auto-resize)
-                print(f"📝 Combining all records into single area with auto-resize...")
+                logger.debug(f"📝 Combining all records into single area with auto-resize...")
                 
                 # Format combined text
-                result_text = f"CRM Results (Page {page_num + 1}):\n" + "=" * 25 + "\n"
+                result_parts = [f"CRM Results (Page {page_num + 1}):\n" + "=" * 25 + "\n"]
                 
-                for i, result in enumerate(crm_results):
-                    result_text += format_single_record_text(result, i + 1) + "\n"
+                for record_body in record_bodies:
+                    result_parts.append(record_body + "\n")
                 
                 # Add extracted page info
-                if parsed_info:
-                    extracted_text = format_extracted_info_text(parsed_info)
-                    if extracted_text:
-                        result_text += extracted_text
+                if extracted_text:
+                    result_parts.append(extracted_text)
+                result_text = "".join(result_parts)
                 
                 # Calculate required dimensions
                 req_width, req_height = calculate_text_dimensions(result_text, font_size, font_type)
                 
                 # Find best available space
-                text_rect = find_blank_space_on_page(doc, page_num, req_width, req_height)
+                text_rect = find_blank_space_on_page(page, req_width, req_height, occupied_areas)
                 
-                print(f"📝 Inserting combined text on page {page_num + 1}:")
-                print(f"   Text length: {len(result_text)} characters")
-                print(f"   Required dimensions: {req_width:.1f} x {req_height:.1f}")
-                print(f"   Available space: {text_rect.width:.1f} x {text_rect.height:.1f}")
+                logger.debug(f"📝 Inserting combined text on page {page_num + 1}: {len(result_text)} characters, "
+                             f"required {req_width:.1f} x {req_height:.1f}, available {text_rect.width:.1f} x {text_rect.height:.1f}")
                 
                 # Insert text with auto-resize
                 success, font_used, size_used = insert_text_with_auto_resize(
@@ -552,99 +873,93 @@ def create_annotated_pdf(original_pdf_path, parsed_info_list, all_crm_rows, outp
                 )
                 
                 if success:
-                    print(f"✅ Added CRM results to page {page_num + 1} ({len(crm_results)} records) with font: {font_used}, size: {size_used}")
+                    logger.info(f"✅ Added CRM results to page {page_num + 1} ({len(crm_results)} records) with font: {font_used}, size: {size_used}")
                 else:
-                    print(f"❌ Failed to add CRM results to page {page_num + 1}")
+                    logger.error(f"❌ Failed to add CRM results to page {page_num + 1}")
                 
             else:
-                print(f"ℹ️ No CRM results for page {page_num + 1}")
+                logger.debug(f"ℹ️ No CRM results for page {page_num + 1}")
         
         # Save the annotated PDF with error handling
         try:
-            print(f"💾 Saving annotated PDF to: {output_path}")
-            doc.save(output_path, garbage=4, deflate=True)
+            logger.info(f"💾 Saving annotated PDF to: {output_path}")
+            if save_mode == 'incremental' and os.path.abspath(output_path) == os.path.abspath(original_pdf_path):
+                # Only the new annotation objects and a new xref section are appended
+                doc.save(output_path, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP)
+            elif save_mode == 'compact':
+                doc.save(output_path, garbage=4, deflate=True)
+            else:
+                # Annotating only adds objects, so a single unused-object pass gets most of the size benefit
+                doc.save(output_path, garbage=1, deflate=True)
             doc.close()
             
             # Verify the saved file
             if os.path.exists(output_path):
                 file_size = os.path.getsize(output_path)
-                print(f"✅ Annotated PDF saved successfully:")
-                print(f"   Path: {output_path}")
-                print(f"   Size: {file_size} bytes")
+                logger.info(f"✅ Annotated PDF saved successfully: {output_path} ({file_size} bytes)")
                 
                 # Quick PDF validation
                 try:
                     with open(output_path, 'rb') as f:
                         header = f.read(4)
                         if header == b'%PDF':
-                            print("✅ PDF file validation passed")
+                            logger.debug("✅ PDF file validation passed")
                             return True
                         else:
-                            print(f"❌ Invalid PDF header: {header}")
+                            logger.error(f"❌ Invalid PDF header: {header}")
                             return False
                 except Exception as e:
-                    print(f"❌ Error validating PDF: {e}")
+                    logger.error(f"❌ Error validating PDF: {e}")
                     return False
             else:
-                print(f"❌ PDF file was not created at: {output_path}")
+                logger.error(f"❌ PDF file was not created at: {output_path}")
                 return False
                 
         except Exception as save_error:
-            print(f"❌ Error saving PDF: {save_error}")
+            logger.error(f"❌ Error saving PDF: {save_error}")
             if doc:
                 doc.close()
             return False
         
     except Exception as e:
-        print(f"❌ Error creating annotated PDF: {e}")
+        logger.error(f"❌ Error creating annotated PDF: {e}")
         return False
 
 def parse_bank_info(text):
-    """Parse key information using xAI Grok API - handles both single page and multi-page text"""
+    """Parse key information using xAI Grok API - handles both single page and multi-page text.
+    text is a single text, or a list with one text per PDF page. Pages are sent one per request, with the requests
+    running concurrently; page numbers come from each page's position in the list"""
     load_dotenv()
     api_key = os.getenv('XAI_API_KEY')
     if not api_key:
-        print("❌ XAI_API_KEY not found in .env")
+        logger.error("❌ XAI_API_KEY not found in .env")
         return []
 
-    print(f"✅ Grok API key loaded successfully")
-    client = OpenAI(
-        api_key=api_key,
-        base_url="https://api.x.ai/v1",
-    )
+    logger.debug(f"✅ Grok API key loaded successfully")
+    client = get_grok_client(api_key)
     
-    # Check if this is multi-page text (contains ------)
-    if "------" in text:
-        # Count pages to ensure proper mapping
-        pages = text.split("------")
-        page_count = len(pages)
-        
-        prompt = f"""Extract information from this multi-page bank payment advice text. Each page is separated by "------".
-                
-                CRITICAL REQUIREMENTS:
-                1. You MUST return exactly {page_count} records - one for each page
-                2. Process pages in order (PAGE 1, PAGE 2, etc.)
-                3. If a page has multiple invoice numbers, put ALL of them in the invoice field separated by commas
-                4. Even if a page appears empty or has no payment info, still create a record for it
-                
-                For each page, extract all available information:
-                - date: The payment date (if available, otherwise null)
-                - amount: The payment amount with currency (if available, otherwise null)
-                - payee: The recipient name (if available, otherwise null)
-                - payer: The sender name (if available, otherwise null)
-                - reference: Any reference number (if available, otherwise null)
-                - invoice: ALL invoice numbers found on this page (e.g., "25-AVS-RES-00109-RN" or "25-AVS-RET-00161-RN,25-AVS-RET-00162-RN" if multiple), otherwise null
-                - page_number: The page number (1, 2, 3, etc.)
-
-                Return exactly {page_count} objects as a JSON array. Each page gets exactly one record.
-
-                Text:
-                {text}
+    # A single text (image, or a one-page PDF) is parsed as is
+    if isinstance(text, str) or len(text) <= 1:
+        return _parse_payment_text(client, text if isinstance(text, str) else ''.join(text))
+
+    pages = text
+    logger.info(f"🔀 Parsing {len(pages)} pages with up to {GROK_MAX_CONCURRENCY} concurrent Grok requests")
+    with ThreadPoolExecutor(max_workers=min(GROK_MAX_CONCURRENCY, len(pages))) as executor:
+        page_results = list(executor.map(lambda page_text: _parse_payment_text(client, page_text), pages))
+    if not any(page_results):
+        return []
 
-                Respond only with valid JSON array containing exactly {page_count} objects.
-                """
-    else:
-        prompt = f"""Extract the following information from this bank payment advice text as a JSON object:
+    # Exactly one record per page, in page order, so page indexes keep lining up with the PDF
+    parsed_info_list = []
+    for page_number, records in enumerate(page_results, 1):
+        record = dict(records[0]) if records else {}
+        record['page_number'] = page_number
+        parsed_info_list.append(record)
+    return parsed_info_list
+
+def _parse_payment_text(client, text):
+    """Ask Grok for the payment fields of one page of text. Returns a list of records ([] on failure)"""
+    prompt = f"""Extract the following information from this bank payment advice text as a JSON object:
                 - date: The payment date (if available, otherwise null)
                 - amount: The payment amount with currency (if available, otherwise null)
                 - payee: The recipient name (if available, otherwise null)
@@ -659,11 +974,7 @@ def parse_bank_info(text):
                 """
     
     try:
-        print(f"🚀 Making API call to Grok (xAI) API...")
-        print(f"   🤖 Model: grok-code-fast-1")
-        print(f"   📝 Prompt length: {len(prompt)} characters")
-        print(f"   🌐 Endpoint: https://api.x.ai/v1/chat/completions")
-        print(f"   ⏰ Starting request at: {time.strftime('%Y-%m-%d %H:%M:%S')}")
+        logger.info(f"🚀 Making API call to Grok (xAI) API - model grok-code-fast-1, prompt {len(prompt)} characters")
 
         response = client.chat.completions.create(
             model="grok-code-fast-1",
@@ -674,16 +985,11 @@ def parse_bank_info(text):
             temperature=0.1,
         )
 
-        print(f"✅ Grok API request completed successfully!")
-        print(f"   📊 Response received at: {time.strftime('%Y-%m-%d %H:%M:%S')}")
+        logger.info("✅ Grok API request completed successfully!")
         extracted_json = response.choices[0].message.content.strip()
         
-        # Print Grok results to terminal
-        print("\n" + "="*60)
-        print("🤖 GROK LLM RESPONSE:")
-        print("="*60)
-        print(extracted_json)
-        print("="*60 + "\n")
+        # Log Grok results (debug level)
+        logger.debug(f"\n{'=' * 60}\n🤖 GROK LLM RESPONSE:\n{'=' * 60}\n{extracted_json}\n{'=' * 60}\n")
         
         # Remove any markdown code block formatting if present
         if extracted_json.startswith("```json"):
@@ -692,12 +998,11 @@ def parse_bank_info(text):
             extracted_json = extracted_json[:-3]
         extracted_json = extracted_json.strip()
         
-        parsed_data = json.loads(extracted_json)
+        parsed_data = orjson.loads(extracted_json)
         
-        # Print parsed data for verification
-        print("📋 PARSED DATA:")
-        print(json.dumps(parsed_data, indent=2, ensure_ascii=False))
-        print("="*60 + "\n")
+        # Log parsed data for verification - only pretty-printed when debug logging is on
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"📋 PARSED DATA:\n{orjson.dumps(parsed_data, option=orjson.OPT_INDENT_2).decode()}\n{'=' * 60}\n")
         
         # Ensure we always return a list
         if isinstance(parsed_data, dict):
@@ -709,7 +1014,7 @@ def parse_bank_info(text):
             return []
             
     except Exception as e:
-        print(f"❌ Error calling xAI API: {e}")
+        logger.error(f"❌ Error calling xAI API: {e}")
         return []
 
 def split_invoice_numbers(invoice_string):
@@ -718,69 +1023,52 @@ def split_invoice_numbers(invoice_string):
         return [None]
     
     # Split by comma and clean up each invoice number
-    invoices = []
-    for inv in invoice_string.split(','):
-        inv = inv.strip()
-        if inv:
-            invoices.append(inv)
-    
-    return invoices if invoices else [None]
+    invoices = [inv for inv in map(str.strip, invoice_string.split(',')) if inv]
+    return invoices or [None]
+
+# All expected CRM result columns in consistent order, each defaulting to an empty cell
+_EXPECTED_DEFAULTS = dict.fromkeys([
+    'Page', 'Source', 'Opened', 'Parent Company Name', 'Premises Name', 
+    'Premises Address', 'Salutation', 'Contact Name', 'Title', 'Business E-Mail', 
+    'Phone Number', 'Licence Category', 'Expected Closed', 'Stage', 
+    'Payment Received Date', 'Invoice No', 'Net Licence Fee', 'Territory', 'Assigned To'
+], '')
 
 def ensure_all_pages_represented(all_crm_rows, parsed_info_list, invoice_to_page_mapping):
     """Ensure all pages are represented in CRM results, even if no results found"""
     if not parsed_info_list:
         return all_crm_rows
     
-    # Define all expected columns in consistent order
-    expected_columns = [
-        'Page', 'Source', 'Opened', 'Parent Company Name', 'Premises Name', 
-        'Premises Address', 'Salutation', 'Contact Name', 'Title', 'Business E-Mail', 
-        'Phone Number', 'Licence Category', 'Expected Closed', 'Stage', 
-        'Payment Received Date', 'Invoice No', 'Net Licence Fee', 'Territory', 'Assigned To'
-    ]
-    
     # Ensure all existing rows have all columns
     for row in all_crm_rows:
-        for col in expected_columns:
-            if col not in row:
-                row[col] = ''
+        for col in _EXPECTED_DEFAULTS:
+            row.setdefault(col, '')
     
     # Create a set of pages that have results
-    pages_with_results = set()
-    for row in all_crm_rows:
-        page_index = row.get('_page_index')
-        if page_index is not None:
-            pages_with_results.add(page_index)
+    pages_with_results = {row['_page_index'] for row in all_crm_rows if row.get('_page_index') is not None}
+    missing_pages = set(range(len(parsed_info_list))) - pages_with_results
+
+    # Invoice of each page, looked up once instead of scanning the mapping per page (first mapping wins)
+    page_to_invoice = {}
+    for mapping in invoice_to_page_mapping:
+        page_to_invoice.setdefault(mapping['page_index'], mapping['invoice'])
     
     # Add empty rows for pages without results
-    for page_idx in range(len(parsed_info_list)):
-        if page_idx not in pages_with_results:
-            # Find the corresponding invoice mapping for this page
-            invoice_for_page = None
-            for mapping in invoice_to_page_mapping:
-                if mapping['page_index'] == page_idx:
-                    invoice_for_page = mapping['invoice']
-                    break
-            
-            # Create an empty editable row for this page with all expected columns
-            empty_row = {
-                '_page_index': page_idx,
-                '_invoice_index': page_idx,
-                '_page_info': parsed_info_list[page_idx] if page_idx < len(parsed_info_list) else {},
-                '_original_invoice_string': invoice_for_page,
-                '_source_invoice': invoice_for_page or f"Page {page_idx + 1}",
-            }
-            
-            # Add all expected columns
-            for col in expected_columns:
-                if col == 'Page':
-                    empty_row[col] = f"Page {page_idx + 1}"
-                elif col == 'Source':
-                    empty_row[col] = invoice_for_page or "No Invoice"
-                else:
-                    empty_row[col] = ''
-                    
-            all_crm_rows.append(empty_row)
+    for page_idx in sorted(missing_pages):
+        invoice_for_page = page_to_invoice.get(page_idx)
+        
+        # Create an empty editable row for this page with all expected columns
+        empty_row = {
+            '_page_index': page_idx,
+            '_invoice_index': page_idx,
+            '_page_info': parsed_info_list[page_idx] if page_idx < len(parsed_info_list) else {},
+            '_original_invoice_string': invoice_for_page,
+            '_source_invoice': invoice_for_page or f"Page {page_idx + 1}",
+            **_EXPECTED_DEFAULTS,
+            'Page': f"Page {page_idx + 1}",
+            'Source': invoice_for_page or "No Invoice",
+        }
+        all_crm_rows.append(empty_row)
     
     # Sort by page index to maintain order
     all_crm_rows.sort(key=lambda x: x.get('_page_index', 0))
@@ -790,63 +1078,146 @@ def ensure_all_pages_represented(all_crm_rows, parsed_info_list, invoice_to_page
 def extract_invoice(file_path: str) -> tuple[list[str], list[dict], list[dict]]:
     """Extract invoice numbers and parsed info from image or PDF. 
     Returns (all_invoice_numbers, parsed_info_list, invoice_to_page_mapping)"""
-    if is_pdf_file(file_path):
-        print(f"📄 Processing PDF file: {file_path}")
-        extracted_text = extract_text_from_pdf_pages(file_path)
-        if not extracted_text:
-            print(f"❌ Failed to extract text from PDF: {file_path}")
+    return _extract_invoice(file_path, file_path)
+
+def extract_invoice_from_bytes(data: bytes, filename: str) -> tuple[list[str], list[dict], list[dict]]:
+    """Same as extract_invoice for a file already held in memory - the PDF or image is decoded straight from the bytes"""
+    return _extract_invoice(data, filename)
+
+def _extract_invoice(source, name):
+    """extract_invoice implementation. source is a file path or the file's bytes, name is used for the file type and messages"""
+    if is_pdf_file(name):
+        logger.info(f"📄 Processing PDF file: {name}")
+        page_texts = extract_text_from_pdf_pages(source)
+        if not page_texts:
+            logger.error(f"❌ Failed to extract text from PDF: {name}")
             return [], [], []
 
-        print(f"🚀 Sending PDF extracted text to Grok API for parsing...")
-        print(f"   📊 Text length: {len(extracted_text)} characters")
-        print(f"   📄 Processing PDF: {file_path}")
-        parsed_info_list = parse_bank_info(extracted_text)
+        logger.info(f"🚀 Sending PDF extracted text to Grok API for parsing...")
+        logger.info(f"   📊 Text length: {sum(map(len, page_texts))} characters in {len(page_texts)} page(s)")
+        logger.info(f"   📄 Processing PDF: {name}")
+        parsed_info_list = parse_bank_info(page_texts)
     else:
-        print(f"🖼️ Processing image file: {file_path}")
-        image = cv2.imread(file_path)
+        logger.info(f"🖼️ Processing image file: {name}")
+        if isinstance(source, bytes):
+            image = cv2.imdecode(np.frombuffer(source, np.uint8), cv2.IMREAD_COLOR)
+        else:
+            image = cv2.imread(source)
         if image is None:
-            print(f"❌ Failed to load image: {file_path}")
+            logger.error(f"❌ Failed to load image: {name}")
             return [], [], []
 
         preprocessed = preprocess_image(image)
-        extracted_text = extract_text_with_api(preprocessed)
+        extracted_text = _compact_for_llm(extract_text_with_api(preprocessed))
 
-        print(f"🚀 Sending image extracted text to Grok API for parsing...")
-        print(f"   📊 Text length: {len(extracted_text)} characters")
-        print(f"   🖼️ Processing image: {file_path}")
+        logger.info(f"🚀 Sending image extracted text to Grok API for parsing...")
+        logger.info(f"   📊 Text length: {len(extracted_text)} characters")
+        logger.info(f"   🖼️ Processing image: {name}")
         parsed_info_list = parse_bank_info(extracted_text)
     
     # Process each page's invoices and create mapping
-    all_invoice_numbers = []
-    invoice_to_page_mapping = []
-    
-    for page_idx, info in enumerate(parsed_info_list):
-        page_invoice_string = info.get('invoice')
-        page_invoices = split_invoice_numbers(page_invoice_string)
-        
-        # Add each invoice with its page mapping
-        for invoice in page_invoices:
-            all_invoice_numbers.append(invoice)
-            invoice_to_page_mapping.append({
-                'invoice': invoice,
-                'page_index': page_idx,
-                'page_info': info,
-                'original_invoice_string': page_invoice_string
-            })
+    invoice_to_page_mapping = [
+        {
+            'invoice': invoice,
+            'page_index': page_idx,
+            'page_info': info,
+            'original_invoice_string': info.get('invoice')
+        }
+        for page_idx, info in enumerate(parsed_info_list)
+        for invoice in split_invoice_numbers(info.get('invoice'))
+    ]
+    all_invoice_numbers = [mapping['invoice'] for mapping in invoice_to_page_mapping]
     
-    print(f"📋 Extracted {len(all_invoice_numbers)} total invoices from {len(parsed_info_list)} pages")
-    for i, mapping in enumerate(invoice_to_page_mapping):
-        print(f"  Invoice {i+1}: {mapping['invoice']} (Page {mapping['page_index']+1})")
+    logger.info(f"📋 Extracted {len(all_invoice_numbers)} total invoices from {len(parsed_info_list)} pages")
+    if logger.isEnabledFor(logging.DEBUG):
+        for i, mapping in enumerate(invoice_to_page_mapping):
+            logger.debug(f"  Invoice {i+1}: {mapping['invoice']} (Page {mapping['page_index']+1})")
     
     return all_invoice_numbers, parsed_info_list, invoice_to_page_mapping
 
+def extract_invoices_batch(file_paths, max_concurrency=8):
+    """Run extract_invoice over several files concurrently.
+    Returns one (all_invoice_numbers, parsed_info_list, invoice_to_page_mapping) tuple per file, in input order"""
+    if not file_paths:
+        return []
+
+    # Each file is dominated by Vision + Grok round-trips, so threads overlap the waiting
+    with ThreadPoolExecutor(max_workers=min(max_concurrency, len(file_paths))) as executor:
+        return list(executor.map(extract_invoice, file_paths))
+
 # ===============================
 # CRM AUTOMATION FUNCTIONS
 # ===============================
 
+# The 'Opportunities' entry of the EWARE_TOP menu dropdown, matched case-insensitively
+OPPORTUNITIES_OPTION_XPATH = (
+    "//select[@id='SELECTMenuOption']/option"
+    "[translate(normalize-space(.), 'ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')='opportunities']"
+)
+
+# Returns the outerHTML of the first results table (CONTENT tables first, like _parse_results),
+# so only that subtree crosses the WebDriver wire instead of the whole page source
+RESULTS_TABLE_JS = """
+var selectors = ['table.CONTENT', 'table'];
+for (var s = 0; s < selectors.length; s++) {
+    var tables = document.querySelectorAll(selectors[s]);
+    for (var i = 0; i < tables.length; i++) {
+        if (tables[i].querySelector('td.ROW1, td.ROW2')) return tables[i].outerHTML;
+    }
+}
+return '';
+"""
+
+# Returns the search form's Search/Find button, trying the known selectors in order of preference,
+# in a single WebDriver call instead of one find_element (and exception) per selector
+SEARCH_BUTTON_JS = """
+var selectors = ["a.ButtonItem[href*='EntryForm.submit']", "a.ButtonItem img[src*='Search.gif']", "[name='Find']"];
+for (var s = 0; s < selectors.length; s++) {
+    var button = document.querySelector(selectors[s]);
+    if (button) return button;
+}
+return null;
+"""
+
+# chromedriver path resolved by webdriver-manager, cached so each browser start skips its version check
+CHROMEDRIVER_RECHECK_INTERVAL = 7 * 24 * 3600  # seconds before asking webdriver-manager again
+_chromedriver_path = None
+_chromedriver_checked_at = 0.0
+_chromedriver_lock = threading.Lock()
+
+def get_chromedriver_path():
+    """Return the chromedriver binary path, only calling ChromeDriverManager().install() on first use or weekly"""
+    global _chromedriver_path, _chromedriver_checked_at
+    with _chromedriver_lock:
+        if (_chromedriver_path is None
+                or time.time() - _chromedriver_checked_at > CHROMEDRIVER_RECHECK_INTERVAL
+                or not os.path.exists(_chromedriver_path)):
+            _chromedriver_path = ChromeDriverManager().install()
+            _chromedriver_checked_at = time.time()
+        return _chromedriver_path
+
+DRIVER_IDLE_TIMEOUT = 15 * 60  # seconds an unused pooled browser is kept alive
+CRM_WARM_SESSIONS = min(4, os.cpu_count() or 1)  # browsers logged in ahead of the first upload
+CRM_MAX_IDLE_SESSIONS = 4  # pooled browsers kept per mode (headless/visible), enough for one parallel CRM run
+# Separator for searching several invoice numbers in one CRM query (e.g. ','), if the CRM's invoice field
+# supports it. Unset: one search per invoice.
+CRM_BULK_SEARCH_DELIMITER = os.getenv('CRM_BULK_SEARCH_DELIMITER') or None
+# Subresources the CRM pages never need for reading the search form and result table.
+# Stylesheets are left alone because the clickable/visible checks on the menu depend on them.
+CRM_BLOCKED_URLS = ['*.gif', '*.png', '*.jpg', '*.jpeg', '*.ico', '*.woff', '*.woff2', '*.ttf',
+                    '*/analytics/*', '*/telemetry/*']
+
+def _quit_driver(driver):
+    """Quit a browser, ignoring errors from sessions that already died"""
+    try:
+        driver.quit()
+    except Exception:
+        pass
+
 class CRMAutoLogin:
     def __init__(self, headless: bool = False, invoice_number: str = None, invoice_numbers: list = None, 
-                 invoice_to_page_mapping: list = None, return_json: bool = False, no_interactive: bool = False, web_output: bool = False):
+                 invoice_to_page_mapping: list = None, return_json: bool = False, no_interactive: bool = False, web_output: bool = False,
+                 max_workers: int = 4, bulk_search_delimiter: str = CRM_BULK_SEARCH_DELIMITER):
         self.url = "http://192.168.1.152/crm/eware.dll/go"
         self.username = "ivan.chiu"
         self.password = "25207090"
@@ -857,7 +1228,24 @@ class CRMAutoLogin:
         self.return_json = return_json
         self.no_interactive = no_interactive
         self.web_output = web_output
+        self.max_workers = max_workers  # Parallel browser sessions used for multi-invoice searches
+        self.bulk_search_delimiter = bulk_search_delimiter  # Search all invoices in one query, see CRM_BULK_SEARCH_DELIMITER
+        self.driver = None
+        self._current_frame = None  # Name of the frame the driver is switched into, None for the top document
+        self._waits = {}  # WebDriverWait per timeout for _waits_driver, see _wait
+        self._waits_driver = None
         
+    def _wait(self, timeout=10):
+        """WebDriverWait on the current driver, created once per driver and timeout and reused by every wait.
+        All explicit waits poll every 0.25s."""
+        if self._waits_driver is not self.driver:
+            self._waits = {}
+            self._waits_driver = self.driver
+        wait = self._waits.get(timeout)
+        if wait is None:
+            wait = self._waits[timeout] = WebDriverWait(self.driver, timeout, poll_frequency=0.25)
+        return wait
+
     def setup_browser(self):
         """Setup Selenium Chrome browser"""
         chrome_options = Options()
@@ -867,24 +1255,42 @@ class CRMAutoLogin:
             chrome_options.add_argument('--window-size=1920,1080')
         chrome_options.add_argument('--no-sandbox')
         chrome_options.add_argument('--disable-dev-shm-usage')
+        # Only the DOM is needed to read the CRM tables - skip images, notifications and background work,
+        # and return from navigation at DOMContentLoaded instead of waiting for every subresource
+        chrome_options.add_argument('--blink-settings=imagesEnabled=false')
+        chrome_options.add_argument('--disable-extensions')
+        chrome_options.add_argument('--disable-background-networking')
+        chrome_options.add_argument('--disable-features=Translate,BackForwardCache')
+        chrome_options.add_experimental_option('prefs', {
+            'profile.managed_default_content_settings.images': 2,
+            'profile.default_content_setting_values.notifications': 2,
+        })
+        chrome_options.page_load_strategy = 'eager'
         try:
-            service = Service(ChromeDriverManager().install())
+            service = Service(get_chromedriver_path())
             self.driver = webdriver.Chrome(service=service, options=chrome_options)
-            print("✅ Selenium Chrome browser initialized successfully")
+            # Block the requests at the network layer (DevTools) so they are never even sent
+            try:
+                self.driver.execute_cdp_cmd('Network.enable', {})
+                self.driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': CRM_BLOCKED_URLS})
+            except Exception as e:
+                crm_logger.warning(f"⚠️ Could not block CRM subresources: {e}")
+            crm_logger.info("✅ Selenium Chrome browser initialized successfully")
             return True
         except Exception as e:
-            print(f"❌ Failed to initialize Selenium Chrome browser: {e}")
+            crm_logger.error(f"❌ Failed to initialize Selenium Chrome browser: {e}")
             return False
     
     def open_website(self):
         """Open the CRM website"""
         try:
-            print(f"🌐 Opening website: {self.url}")
+            crm_logger.info(f"🌐 Opening website: {self.url}")
             self.driver.get(self.url)
-            print("✅ Website opened successfully")
+            self._current_frame = None
+            crm_logger.info("✅ Website opened successfully")
             return True
         except Exception as e:
-            print(f"❌ Failed to open website: {e}")
+            crm_logger.error(f"❌ Failed to open website: {e}")
             return False
     
     def login(self, max_retries=3):
@@ -893,242 +1299,216 @@ class CRMAutoLogin:
 
         while retry_count < max_retries:
             try:
-                print("🔐 Starting login process...")
-                time.sleep(2)
+                crm_logger.info("🔐 Starting login process...")
+                # Wait for either the login form or an already-logged-in frameset instead of a fixed delay
+                self._wait(15).until(
+                    lambda d: d.find_elements(By.NAME, "EWARE_USERID") or d.find_elements(By.NAME, "EWARE_MENU")
+                )
                 
                 # First check if we're already logged in by looking for Logonbutton elements
                 logon_buttons = self.driver.find_elements(By.CLASS_NAME, "Logonbutton")
-                print(f"🔍 Found {len(logon_buttons)} Logonbutton elements on page load")
+                crm_logger.debug(f"🔍 Found {len(logon_buttons)} Logonbutton elements on page load")
                 
                 if len(logon_buttons) == 0:
-                    print("✅ No login buttons found - already logged in!")
+                    crm_logger.info("✅ No login buttons found - already logged in!")
                     return self._handle_already_logged_in()
                 
-                username_field = self.driver.find_element(By.NAME, "EWARE_USERID")
-                if not username_field:
-                    print("❌ Username field not found")
-                    return False
-                print("✅ Found username field")
-                username_field.clear()
-                username_field.send_keys(self.username)
-                print(f"✅ Entered username: {self.username}")
-                password_field = self.driver.find_element(By.NAME, "PASSWORD")
-                if not password_field:
-                    print("❌ Password field not found")
-                    return False
-                print("✅ Found password field")
-                password_field.clear()
-                password_field.send_keys(self.password)
-                print("✅ Entered password")
-                login_button = self.driver.find_element(By.CLASS_NAME, "Logonbutton")
-                if not login_button:
-                    print("❌ Login button not found")
-                    return False
-                print("✅ Found login button")
-                login_button.click()
-                print("✅ Clicked login button")
+                self._fill_login_js()
+                crm_logger.debug(f"✅ Entered username: {self.username}")
+                crm_logger.debug("✅ Entered password and clicked login button")
 
-                # Wait and check for Logonbutton elements with retry logic
+                # Poll for the post-login Logonbutton elements (same 25s budget as the old 3s..7s sleeps)
                 logon_buttons_found = False
-                for attempt in range(5):  # Try up to 5 times with increasing wait
-                    time.sleep(3 + attempt)  # Start with 3s, then 4s, 5s, 6s, 7s
-                    logon_buttons = self.driver.find_elements(By.CLASS_NAME, "Logonbutton")
-                    print(f"🔄 Attempt {attempt + 1}: Found {len(logon_buttons)} Logonbutton elements")
-
-                    if len(logon_buttons) >= 3:
-                        logon_buttons_found = True
-                        print(f"✅ Successfully found {len(logon_buttons)} Logonbutton elements")
-                        break
-                    elif attempt < 4:  # Don't print this on the last attempt
-                        print(f"⏳ Waiting longer for page to load... ({3 + attempt + 1}s)")
+                try:
+                    self._wait(25).until(
+                        lambda d: len(d.find_elements(By.CLASS_NAME, "Logonbutton")) >= 3
+                    )
+                    logon_buttons_found = True
+                except TimeoutException:
+                    pass
+                logon_buttons = self.driver.find_elements(By.CLASS_NAME, "Logonbutton")
+                if logon_buttons_found:
+                    crm_logger.debug(f"✅ Successfully found {len(logon_buttons)} Logonbutton elements")
 
                 if not logon_buttons_found:
                     if retry_count < max_retries - 1:
-                        print(f"❌ Found only {len(logon_buttons)} Logonbutton(s), need at least 3. Retrying... ({retry_count + 1}/{max_retries})")
+                        crm_logger.error(f"❌ Found only {len(logon_buttons)} Logonbutton(s), need at least 3. Retrying... ({retry_count + 1}/{max_retries})")
                         retry_count += 1
                         # Refresh the page and try again
                         self.driver.refresh()
-                        time.sleep(2)
+                        self._current_frame = None
                         continue
                     else:
-                        print(f"❌ Found only {len(logon_buttons)} Logonbutton(s), need at least 3 for the third one. All {max_retries} retries failed.")
+                        crm_logger.error(f"❌ Found only {len(logon_buttons)} Logonbutton(s), need at least 3 for the third one. All {max_retries} retries failed.")
                         return False
 
+                # find_element raises rather than returning None, so look the link up with find_elements
                 third_button = logon_buttons[2]
-                inner_link = third_button.find_element(By.TAG_NAME, "a")
-                if inner_link:
-                    inner_link.click()
-                else:
-                    third_button.click()
-                print("✅ Clicked the third Logonbutton")
-                time.sleep(3)
-                print("✅ 3-second wait completed")
+                inner_links = third_button.find_elements(By.TAG_NAME, "a")
+                (inner_links[0] if inner_links else third_button).click()
+                self._current_frame = None
+                crm_logger.debug("✅ Clicked the third Logonbutton")
 
                 # If we get here, login was successful
-                # --- Switch to left navigation frame (EWARE_MENU) and click the Find button ---
-                self.driver.switch_to.default_content()
-                try:
-                    self.driver.switch_to.frame("EWARE_MENU")
-                except Exception:
-                    print("⚠️ Could not switch to frame 'EWARE_MENU' – trying alternative method")
-                    menu_frame = WebDriverWait(self.driver, 10).until(
-                        EC.frame_to_be_available_and_switch_to_it((By.NAME, "EWARE_MENU"))
-                    )
-                try:
-                    find_button = WebDriverWait(self.driver, 10).until(
-                        EC.element_to_be_clickable((By.ID, "Find"))
-                    )
-                    print("✅ Found Find button")
-                    find_button.click()
-                    print("✅ Clicked Find button")
-                except Exception as e:
-                    print(f"❌ Find button not found or not clickable: {e}")
-                    return False
-
-                # --- Switch to top frame (EWARE_TOP) to access dropdown ---
-                self.driver.switch_to.default_content()
-                try:
-                    self.driver.switch_to.frame("EWARE_TOP")
-                except Exception:
-                    print("⚠️ Could not switch to frame 'EWARE_TOP' – trying alternative method")
-                    WebDriverWait(self.driver, 10).until(
-                        EC.frame_to_be_available_and_switch_to_it((By.NAME, "EWARE_TOP"))
-                    )
-
-                select_elem = WebDriverWait(self.driver, 10).until(
-                    EC.presence_of_element_located((By.ID, "SELECTMenuOption"))
-                )
-                print("✅ Found SELECTMenuOption dropdown")
-
-                # Get all options and print them for debugging
-                options = select_elem.find_elements(By.TAG_NAME, "option")
-                print(f"Found {len(options)} options in dropdown:")
-                for i, option in enumerate(options):
-                    print(f"  {i}: '{option.text}'")
-
-                # Select Opportunities option
-                found = False
-                for option in options:
-                    if option.text.strip().lower() == 'opportunities':
-                        option.click()
-                        found = True
-                        print("✅ Selected 'Opportunities' option")
-                        break
-                if not found:
-                    print("❌ 'Opportunities' option not found in dropdown")
-                    return False
-                time.sleep(3)  # Wait for page to load after selecting Opportunities
-
-                # Switch back to main content frame for invoice input
-                self.driver.switch_to.default_content()
-                try:
-                    self.driver.switch_to.frame("EWARE_MID")
-                except Exception:
-                    print("⚠️ Could not switch to frame 'EWARE_MID' – trying alternative method")
-                    WebDriverWait(self.driver, 10).until(
-                        EC.frame_to_be_available_and_switch_to_it((By.NAME, "EWARE_MID"))
-                    )
-                return True
+                return self._navigate_to_opportunities(menu_timeout=15)
 
             except Exception as e:
                 if retry_count < max_retries - 1:
-                    print(f"❌ Login attempt {retry_count + 1} failed: {e}")
-                    print(f"🔄 Retrying login... ({retry_count + 2}/{max_retries})")
+                    crm_logger.error(f"❌ Login attempt {retry_count + 1} failed: {e}")
+                    crm_logger.info(f"🔄 Retrying login... ({retry_count + 2}/{max_retries})")
                     retry_count += 1
                     # Refresh the page and try again
                     self.driver.refresh()
-                    time.sleep(2)
+                    self._current_frame = None
                     continue
                 else:
-                    print(f"❌ Login failed after {max_retries} attempts: {e}")
+                    crm_logger.error(f"❌ Login failed after {max_retries} attempts: {e}")
                     return False
 
         return False
 
-    def _handle_already_logged_in(self):
-        """Handle the case when user is already logged in"""
+    def _ensure_frame(self, name, timeout=10):
+        """Switch into the named frame, skipping the WebDriver round-trips when the driver is already in it"""
+        if self._current_frame == name:
+            return
+        self.driver.switch_to.default_content()
+        self._current_frame = None
+        # Returns on the first poll if the frame is already there, otherwise waits for it to load
+        self._wait(timeout).until(EC.frame_to_be_available_and_switch_to_it((By.NAME, name)))
+        self._current_frame = name
+
+    def _click_and_wait_for_results(self, search_button, timeout=20):
+        """Click the search button and wait until the frame has loaded the result page, instead of a fixed delay.
+        The search submits the form, so the old document going stale marks the start of the new page."""
+        old_page = self.driver.find_element(By.TAG_NAME, "html")
+        search_button.click()
         try:
-            print("🔄 Setting up CRM navigation since already logged in...")
-            
-            # Switch to left navigation frame (EWARE_MENU) and click the Find button
-            self.driver.switch_to.default_content()
-            try:
-                self.driver.switch_to.frame("EWARE_MENU")
-            except Exception:
-                print("⚠️ Could not switch to frame 'EWARE_MENU' – trying alternative method")
-                menu_frame = WebDriverWait(self.driver, 10).until(
-                    EC.frame_to_be_available_and_switch_to_it((By.NAME, "EWARE_MENU"))
-                )
-            try:
-                find_button = WebDriverWait(self.driver, 10).until(
-                    EC.element_to_be_clickable((By.ID, "Find"))
-                )
-                print("✅ Found Find button")
-                find_button.click()
-                print("✅ Clicked Find button")
-            except Exception as e:
-                print(f"❌ Find button not found or not clickable: {e}")
-                return False
+            self._wait(timeout).until(EC.staleness_of(old_page))
+            self._wait(timeout).until(
+                lambda d: d.execute_script("return document.readyState !== 'loading';")
+            )
+        except TimeoutException:
+            crm_logger.warning(f"⚠️ Search results did not finish loading within {timeout}s - parsing what is there")
+
+    def _fill_login_js(self):
+        """Fill in the credentials and click the login button in a single WebDriver round-trip"""
+        self.driver.execute_script(
+            "var fields = [document.getElementsByName('EWARE_USERID')[0], document.getElementsByName('PASSWORD')[0]];"
+            "fields[0].value = arguments[0];"
+            "fields[1].value = arguments[1];"
+            "fields.forEach(function (field) { field.dispatchEvent(new Event('change', {bubbles: true})); });"
+            "var button = document.getElementsByClassName('Logonbutton')[0];"
+            "(button.querySelector('a') || button).click();",
+            self.username, self.password
+        )
 
-            # Switch to top frame (EWARE_TOP) to access dropdown
-            self.driver.switch_to.default_content()
-            try:
-                self.driver.switch_to.frame("EWARE_TOP")
-            except Exception:
-                print("⚠️ Could not switch to frame 'EWARE_TOP' – trying alternative method")
-                WebDriverWait(self.driver, 10).until(
-                    EC.frame_to_be_available_and_switch_to_it((By.NAME, "EWARE_TOP"))
-                )
+    def _set_field_value(self, field, value):
+        """Set an input's value in one WebDriver call (instead of a keystroke at a time) and fire input/change events"""
+        self.driver.execute_script(
+            "arguments[0].value = arguments[1];"
+            "arguments[0].dispatchEvent(new Event('input', {bubbles: true}));"
+            "arguments[0].dispatchEvent(new Event('change', {bubbles: true}));",
+            field, value
+        )
 
-            select_elem = WebDriverWait(self.driver, 10).until(
-                EC.presence_of_element_located((By.ID, "SELECTMenuOption"))
+    def _navigate_to_opportunities(self, menu_timeout=10):
+        """Open the Opportunities search form: Find in the left menu, Opportunities in the top dropdown, then wait
+        for the form in the main frame. Returns False if a menu item is missing; other errors are left to the caller"""
+        # Switch to left navigation frame (EWARE_MENU) and click the Find button
+        self._ensure_frame("EWARE_MENU", timeout=menu_timeout)
+        try:
+            find_button = self._wait().until(
+                EC.element_to_be_clickable((By.ID, "Find"))
             )
-            print("✅ Found SELECTMenuOption dropdown")
-
-            # Get all options and print them for debugging
-            options = select_elem.find_elements(By.TAG_NAME, "option")
-            print(f"Found {len(options)} options in dropdown:")
-            for i, option in enumerate(options):
-                print(f"  {i}: '{option.text}'")
-
-            # Select Opportunities option
-            found = False
-            for option in options:
-                if option.text.strip().lower() == 'opportunities':
-                    option.click()
-                    found = True
-                    print("✅ Selected 'Opportunities' option")
-                    break
-            if not found:
-                print("❌ 'Opportunities' option not found in dropdown")
-                return False
-            time.sleep(3)  # Wait for page to load after selecting Opportunities
+            crm_logger.debug("✅ Found Find button")
+            find_button.click()
+            crm_logger.debug("✅ Clicked Find button")
+        except Exception as e:
+            crm_logger.error(f"❌ Find button not found or not clickable: {e}")
+            return False
 
-            # Switch back to main content frame for invoice input
-            self.driver.switch_to.default_content()
-            try:
-                self.driver.switch_to.frame("EWARE_MID")
-            except Exception:
-                print("⚠️ Could not switch to frame 'EWARE_MID' – trying alternative method")
-                WebDriverWait(self.driver, 10).until(
-                    EC.frame_to_be_available_and_switch_to_it((By.NAME, "EWARE_MID"))
-                )
+        # Switch to top frame (EWARE_TOP) to access dropdown
+        self._ensure_frame("EWARE_TOP")
+
+        # Select Opportunities option - matched by XPath in the browser rather than reading every option's text
+        try:
+            opportunities_option = self._wait().until(
+                EC.presence_of_element_located((By.XPATH, OPPORTUNITIES_OPTION_XPATH))
+            )
+        except TimeoutException:
+            crm_logger.error("❌ 'Opportunities' option not found in dropdown")
+            return False
+        opportunities_option.click()
+        crm_logger.debug("✅ Selected 'Opportunities' option")
+
+        # Switch back to main content frame and wait for the Opportunities search form to load
+        self._ensure_frame("EWARE_MID", timeout=15)
+        self._wait(15).until(
+            EC.presence_of_element_located((By.ID, "oppo_afwinvno"))
+        )
+        return True
+
+    def _handle_already_logged_in(self):
+        """Handle the case when user is already logged in"""
+        try:
+            crm_logger.info("🔄 Setting up CRM navigation since already logged in...")
             
-            print("✅ Successfully set up CRM navigation for already logged in session")
+            if not self._navigate_to_opportunities():
+                return False
+            
+            crm_logger.info("✅ Successfully set up CRM navigation for already logged in session")
             return True
             
         except Exception as e:
-            print(f"❌ Failed to set up CRM navigation: {e}")
+            crm_logger.error(f"❌ Failed to set up CRM navigation: {e}")
             return False
     
     def close(self):
         """Close the browser"""
         if self.driver:
-            try:
-                self.driver.quit()
-            except Exception:
-                pass
-            print("✅ Browser closed")
+            _quit_driver(self.driver)
+            self.driver = None
+            self._current_frame = None
+            crm_logger.info("✅ Browser closed")
+
+    def start_session(self):
+        """Get a logged-in browser: reuse a pooled one if its session is still alive, otherwise start a new one and log in"""
+        while True:
+            self.driver = CRM_SESSIONS.take_driver(self.headless)
+            if self.driver is None:
+                break
+            if self._session_alive():
+                crm_logger.info("♻️ Reusing logged-in browser from pool")
+                return True
+            crm_logger.warning("⚠️ Pooled browser session has expired - discarding it")
+            self.close()
+
+        if not self.setup_browser():
+            return False
+        if not self.open_website():
+            self.close()
+            return False
+        if not self.login():
+            crm_logger.error("❌ Login process failed")
+            self.close()
+            return False
+        return True
+
+    def _session_alive(self):
+        """Check that the browser is still logged in and showing the Opportunities search form"""
+        try:
+            self._ensure_frame("EWARE_MID")
+            return len(self.driver.find_elements(By.ID, "oppo_afwinvno")) > 0
+        except Exception:
+            return False
+
+    def release_session(self):
+        """Hand the logged-in browser back to the shared pool for the next run instead of quitting it"""
+        if self.driver is None:
+            return
+        CRM_SESSIONS.put_driver(self.driver, self.headless)
+        self.driver = None
+        self._current_frame = None
     
     def search_invoice(self, invoice_number):
         """Search for a single invoice and return results"""
@@ -1136,54 +1516,36 @@ class CRMAutoLogin:
         if not invoice_number or invoice_number.strip() == '':
             return self.search_by_fee()
         
-        print(f"🔍 Searching for invoice: {invoice_number}")
+        crm_logger.info(f"🔍 Searching for invoice: {invoice_number}")
         
         # Make sure we're in the correct frame for invoice input
-        self.driver.switch_to.default_content()
+        self._ensure_frame("EWARE_MID")
+        
         try:
-            self.driver.switch_to.frame("EWARE_MID")
-        except Exception:
-            WebDriverWait(self.driver, 10).until(
-                EC.frame_to_be_available_and_switch_to_it((By.NAME, "EWARE_MID"))
+            invoice_field = self._wait().until(
+                EC.presence_of_element_located((By.ID, "oppo_afwinvno"))
             )
-        
-        invoice_field = WebDriverWait(self.driver, 10).until(
-            EC.presence_of_element_located((By.ID, "oppo_afwinvno"))
-        )
-        if not invoice_field:
-            print("❌ Invoice input field not found")
+        except TimeoutException:
+            crm_logger.error("❌ Invoice input field not found")
+            self._current_frame = None  # The page may have navigated away, switch again next time
             return []
         
-        invoice_field.clear()
-        invoice_field.send_keys(invoice_number)
-        print(f"✅ Entered invoice number: {invoice_number}")
-        time.sleep(1)
+        self._set_field_value(invoice_field, invoice_number)
+        crm_logger.debug(f"✅ Entered invoice number: {invoice_number}")
         
-        # Try different search button selectors
-        search_button = None
-        try:
-            search_button = self.driver.find_element(By.CSS_SELECTOR, "a.ButtonItem[href*='EntryForm.submit']")
-        except:
-            try:
-                search_button = self.driver.find_element(By.CSS_SELECTOR, "a.ButtonItem img[src*='Search.gif']")
-            except:
-                try:
-                    search_button = self.driver.find_element(By.NAME, "Find")
-                except:
-                    search_button = None
+        search_button = self.driver.execute_script(SEARCH_BUTTON_JS)
         
         if search_button:
-            search_button.click()
-            print("✅ Clicked Search/Find button")
-            time.sleep(5)
+            self._click_and_wait_for_results(search_button)
+            crm_logger.debug("✅ Clicked Search/Find button")
         else:
-            print("⚠️ Search/Find button not found - you may need to adjust selector")
+            crm_logger.warning("⚠️ Search/Find button not found - you may need to adjust selector")
             return []
         
         # Parse results
-        html = self.driver.page_source
+        html = self.driver.execute_script(RESULTS_TABLE_JS)
         records = self._parse_results(html)
-        print(f"✅ Found {len(records)} records for invoice {invoice_number}")
+        crm_logger.info(f"✅ Found {len(records)} records for invoice {invoice_number}")
         
         # Add source invoice to each record (only invoice number, no page info)
         for record in records:
@@ -1192,62 +1554,57 @@ class CRMAutoLogin:
             
         return records
 
+    def search_invoices_bulk(self, invoices):
+        """Search several invoices with a single CRM query (numbers joined with bulk_search_delimiter).
+        Returns {invoice: records} for the invoices whose number shows up in the Invoice No column of the results"""
+        wanted = {invoice.strip().upper(): invoice for invoice in invoices}
+        found = {}
+        for record in self.search_invoice(self.bulk_search_delimiter.join(invoices)):
+            invoice = wanted.get(record.get('Invoice No', '').strip().upper())
+            if invoice is not None:
+                record['_source_invoice'] = invoice
+                record['Source'] = invoice
+                found.setdefault(invoice, []).append(record)
+        crm_logger.info(f"📦 Bulk search matched {len(found)}/{len(invoices)} invoices")
+        return found
+
     def search_by_fee(self, fee_amount=""):
         """Search by fee when no invoice number is available"""
-        print(f"🔍 Searching by fee (no invoice number available)")
+        crm_logger.info(f"🔍 Searching by fee (no invoice number available)")
         
         # Make sure we're in the correct frame for fee input
-        self.driver.switch_to.default_content()
-        try:
-            self.driver.switch_to.frame("EWARE_MID")
-        except Exception:
-            WebDriverWait(self.driver, 10).until(
-                EC.frame_to_be_available_and_switch_to_it((By.NAME, "EWARE_MID"))
-            )
+        self._ensure_frame("EWARE_MID")
         
         # Find the fee input field
         try:
-            fee_field = WebDriverWait(self.driver, 10).until(
+            fee_field = self._wait().until(
                 EC.presence_of_element_located((By.ID, "oppo_dwnetlicfee"))
             )
         except Exception as e:
-            print(f"❌ Fee input field not found: {e}")
+            crm_logger.error(f"❌ Fee input field not found: {e}")
+            self._current_frame = None  # The page may have navigated away, switch again next time
             return []
         
         # Clear and enter fee amount (if provided, otherwise leave empty for general search)
-        fee_field.clear()
+        self._set_field_value(fee_field, str(fee_amount) if fee_amount else "")
         if fee_amount:
-            fee_field.send_keys(str(fee_amount))
-            print(f"✅ Entered fee amount: {fee_amount}")
+            crm_logger.debug(f"✅ Entered fee amount: {fee_amount}")
         else:
-            print("✅ Fee field cleared for general search")
-        time.sleep(1)
+            crm_logger.debug("✅ Fee field cleared for general search")
         
-        # Try different search button selectors
-        search_button = None
-        try:
-            search_button = self.driver.find_element(By.CSS_SELECTOR, "a.ButtonItem[href*='EntryForm.submit']")
-        except:
-            try:
-                search_button = self.driver.find_element(By.CSS_SELECTOR, "a.ButtonItem img[src*='Search.gif']")
-            except:
-                try:
-                    search_button = self.driver.find_element(By.NAME, "Find")
-                except:
-                    search_button = None
+        search_button = self.driver.execute_script(SEARCH_BUTTON_JS)
         
         if search_button:
-            search_button.click()
-            print("✅ Clicked Search/Find button for fee search")
-            time.sleep(5)
+            self._click_and_wait_for_results(search_button)
+            crm_logger.debug("✅ Clicked Search/Find button for fee search")
         else:
-            print("⚠️ Search/Find button not found - you may need to adjust selector")
+            crm_logger.warning("⚠️ Search/Find button not found - you may need to adjust selector")
             return []
         
         # Parse results
-        html = self.driver.page_source
+        html = self.driver.execute_script(RESULTS_TABLE_JS)
         records = self._parse_results(html)
-        print(f"✅ Found {len(records)} records for fee search")
+        crm_logger.info(f"✅ Found {len(records)} records for fee search")
         
         # Add source info to each record
         source_value = f"fee_search_{fee_amount}" if fee_amount else "fee_search_general"
@@ -1257,49 +1614,60 @@ class CRMAutoLogin:
             
         return records
 
+    def _annotate_records(self, records, i, invoice):
+        """Add invoice/page mapping information to the records found for invoice number i"""
+        for record in records:
+            record['_invoice_index'] = i
+            # Find corresponding mapping info
+            if i < len(self.invoice_to_page_mapping):
+                mapping = self.invoice_to_page_mapping[i]
+                record['_page_index'] = mapping['page_index']
+                record['_page_info'] = mapping['page_info']
+                record['_original_invoice_string'] = mapping['original_invoice_string']
+                # Add separate Page column
+                record['Page'] = f"Page {mapping['page_index'] + 1}"
+            else:
+                # Fallback for backward compatibility
+                record['_page_index'] = i
+                record['_page_info'] = {}
+                record['_original_invoice_string'] = invoice
+                record['Page'] = f"Page {i + 1}"
+        return records
+
+    def _process_one(self, session, i, invoice):
+        """Search invoice number i in the given logged-in session and return its annotated records"""
+        return self._annotate_records(session.search_invoice(invoice), i, invoice)
+
     def run(self):
         """Main execution method"""
-        print("🚀 Starting CRM Auto Login...")
-        print("=" * 50)
-        if not self.setup_browser():
+        crm_logger.info("🚀 Starting CRM Auto Login...")
+        crm_logger.info("=" * 50)
+        # Nothing to look up - don't start (or tie up) a browser for it
+        if not any(invoice and invoice.strip() for invoice in self.invoice_numbers):
+            crm_logger.warning("⚠️ No invoices to search - skipping CRM automation")
+            return True, []
+        bulk = bool(self.bulk_search_delimiter) and len(self.invoice_numbers) > 1
+        if not bulk and min(self.max_workers, len(self.invoice_numbers)) > 1:
+            return self._run_parallel()
+        if not self.start_session():
             return False, []
         try:
-            if not self.open_website():
-                return False, []
-            if not self.login():
-                print("❌ Login process failed")
-                return False, []
-            
             all_records = []
             
             if self.invoice_numbers:
+                # One query for all invoice numbers first; only the ones it didn't match are searched one by one
+                found = {}
+                if bulk:
+                    invoices = list(dict.fromkeys(invoice for invoice in self.invoice_numbers if invoice and invoice.strip()))
+                    found = self.search_invoices_bulk(invoices) if invoices else {}
                 for i, invoice in enumerate(self.invoice_numbers):
-                    print(f"📄 Processing invoice {i+1}/{len(self.invoice_numbers)}: {invoice}")
-                    records = self.search_invoice(invoice)
-                    
-                    # Add mapping information to each record
-                    for record in records:
-                        record['_invoice_index'] = i
-                        # Find corresponding mapping info
-                        if i < len(self.invoice_to_page_mapping):
-                            mapping = self.invoice_to_page_mapping[i]
-                            record['_page_index'] = mapping['page_index']
-                            record['_page_info'] = mapping['page_info']
-                            record['_original_invoice_string'] = mapping['original_invoice_string']
-                            # Add separate Page column
-                            record['Page'] = f"Page {mapping['page_index'] + 1}"
-                        else:
-                            # Fallback for backward compatibility
-                            record['_page_index'] = i
-                            record['_page_info'] = {}
-                            record['_original_invoice_string'] = invoice
-                            record['Page'] = f"Page {i + 1}"
-                    
-                    all_records.extend(records)
-                    
-                    # Small delay between searches
-                    if i < len(self.invoice_numbers) - 1:
-                        time.sleep(2)
+                    if invoice in found:
+                        # Copies, since the same invoice number can appear on several pages
+                        records = [dict(record) for record in found[invoice]]
+                        all_records.extend(self._annotate_records(records, i, invoice))
+                        continue
+                    crm_logger.info(f"📄 Processing invoice {i+1}/{len(self.invoice_numbers)}: {invoice}")
+                    all_records.extend(self._process_one(self, i, invoice))
             elif self.invoice_number:
                 # Backward compatibility for single invoice
                 records = self.search_invoice(self.invoice_number)
@@ -1313,240 +1681,580 @@ class CRMAutoLogin:
             
             return True, all_records
         except Exception as e:
-            print(f"❌ Unexpected error: {e}")
+            crm_logger.error(f"❌ Unexpected error: {e}")
+            # The browser is in an unknown state - don't hand it to the next run
+            self.close()
             return False, []
         finally:
-            self.close()
+            self.release_session()
+
+    def _run_parallel(self):
+        """Search the invoices across several logged-in browser sessions at once.
+        Each worker logs in its own browser and pulls invoices from a shared queue until it is empty."""
+        worker_count = min(self.max_workers, len(self.invoice_numbers))
+        crm_logger.info(f"🔀 Searching {len(self.invoice_numbers)} invoices with {worker_count} parallel browser sessions")
+
+        tasks = queue.Queue()
+        for i, invoice in enumerate(self.invoice_numbers):
+            tasks.put((i, invoice))
+        results = [None] * len(self.invoice_numbers)
+
+        def worker(worker_id):
+            session = CRMAutoLogin(headless=self.headless)
+            if not session.start_session():
+                crm_logger.error(f"❌ Worker {worker_id}: could not get a logged-in browser")
+                return
+            try:
+                while True:
+                    try:
+                        i, invoice = tasks.get_nowait()
+                    except queue.Empty:
+                        return
+                    crm_logger.info(f"📄 Worker {worker_id}: processing invoice {i+1}/{len(self.invoice_numbers)}: {invoice}")
+                    results[i] = self._process_one(session, i, invoice)
+            except Exception as e:
+                crm_logger.error(f"❌ Worker {worker_id}: unexpected error: {e}")
+                session.close()
+            finally:
+                session.release_session()
+
+        with ThreadPoolExecutor(max_workers=worker_count) as executor:
+            futures = [executor.submit(worker, worker_id + 1) for worker_id in range(worker_count)]
+            for future in as_completed(futures):
+                future.result()
+
+        # Invoices a worker failed on (or never reached) mean the run failed, as in the serial path
+        if any(records is None for records in results):
+            crm_logger.error("❌ Not all invoices could be searched")
+            return False, []
+
+        # Merge in invoice order so the output matches a sequential run
+        all_records = [record for records in results for record in records]
+        return True, all_records
 
     def _parse_results(self, html: str):
-        """Parse CRM table rows into list of dicts, matching the actual table columns dynamically and robustly."""
-        soup = BeautifulSoup(html, 'html.parser')
-        
-        # Try multiple approaches to find the correct table
+        """Parse CRM table rows into list of dicts, matching the actual table columns dynamically and robustly.
+        Rows are streamed with iterparse and freed once read; parsing stops when the first table with data rows closes."""
+        if not html or not html.strip():
+            crm_logger.error("❌ No table with data rows found")
+            return []
+
+        # One entry per open table, innermost last. Each row belongs to its innermost table, so a grid nested inside
+        # a layout table is read as its own table instead of as cells of the layout row around it.
+        open_tables = []
         table = None
-        
-        # First try: Look for table with CONTENT class
-        tables = soup.find_all('table', class_='CONTENT')
-        print(f"Found {len(tables)} tables with class 'CONTENT'")
-        
-        if len(tables) > 0:
-            # If multiple tables, try to find the one with data rows
-            for i, t in enumerate(tables):
-                rows = t.find_all('tr')
-                data_rows = [r for r in rows if r.find('td', class_='ROW1') or r.find('td', class_='ROW2')]
-                print(f"Table {i}: {len(rows)} total rows, {len(data_rows)} data rows")
-                if len(data_rows) > 0:
-                    table = t
-                    print(f"Selected table {i} with {len(data_rows)} data rows")
-                    break
-        
-        # If no table found, try looking for any table with ROW1/ROW2 classes
-        if not table:
-            all_tables = soup.find_all('table')
-            print(f"Searching through {len(all_tables)} total tables")
-            for i, t in enumerate(all_tables):
-                rows = t.find_all('tr')
-                data_rows = [r for r in rows if r.find('td', class_='ROW1') or r.find('td', class_='ROW2')]
-                if len(data_rows) > 0:
-                    table = t
-                    print(f"Found table {i} with {len(data_rows)} data rows")
+        rows = etree.iterparse(io.BytesIO(html.encode('utf-8')), events=('start', 'end'), tag=('table', 'tr'),
+                               html=True, encoding='utf-8')
+        for event, element in rows:
+            if element.tag == 'table':
+                if event == 'start':
+                    open_tables.append({
+                        'row_count': 0,
+                        'header_texts': None,      # First GRIDHEAD row of the table
+                        'first_row_texts': None,   # Fallback header row
+                        'data_texts': [],          # Cell texts of the data rows (ROW1/ROW2), elements themselves are freed
+                    })
+                    continue
+                closed = open_tables.pop() if open_tables else None
+                # Inner tables close first, so this is the innermost table with data rows
+                if closed is not None and closed['data_texts']:
+                    table = closed
                     break
-        
-        if not table:
-            print("❌ No table with data rows found")
+                continue
+            if event != 'end' or not open_tables:
+                continue
+
+            current = open_tables[-1]
+            current['row_count'] += 1
+            if current['first_row_texts'] is None:
+                current['first_row_texts'] = [_cell_text(cell) for cell in _FIND_HEADER_CELLS(element)]
+            if current['header_texts'] is None and _IS_HEADER_ROW(element):
+                current['header_texts'] = [_cell_text(cell) for cell in _FIND_HEADER_CELLS(element)]
+            if _IS_DATA_ROW(element):
+                cells = _FIND_CELLS(element)
+                if cells:
+                    current['data_texts'].append([_cell_text(cell) for cell in cells])
+
+            # Free the row and everything before it
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+        if table is None:
+            crm_logger.error("❌ No table with data rows found")
             return []
-            
-        rows = table.find_all('tr')
-        if not rows or len(rows) < 2:
-            print("❌ Table has insufficient rows")
+        if table['row_count'] < 2:
+            crm_logger.error("❌ Table has insufficient rows")
             return []
-            
-        # Find the first row with GRIDHEAD class for headers
-        header_row = None
-        for row in rows:
-            if row.find('td', class_='GRIDHEAD'):
-                header_row = row
-                break
-        if not header_row:
-            header_row = rows[0]
-            
-        header_cells = header_row.find_all(['td', 'th'])
-        headers = []
-        for cell in header_cells:
-            a = cell.find('a')
-            if a and a.get_text(strip=True):
-                text = a.get_text(separator=' ', strip=True)
-            else:
-                text = cell.get_text(separator=' ', strip=True)
-            text = text.replace('\xa0', '').strip()
-            headers.append(text)
-            
+        crm_logger.debug(f"Selected table with {table['row_count']} rows")
+
+        headers = table['header_texts'] if table['header_texts'] is not None else table['first_row_texts']
+        data_texts = table['data_texts']
+
         # Remove leading empty headers
         while headers and headers[0] == '':
             headers.pop(0)
-            
-        print(f"Found headers: {headers}")
-        
+
+        crm_logger.debug(f"Found headers: {headers}")
+
         results = []
-        seen_records = set()  # To track duplicates
-        
-        for row in rows:
-            # Only process data rows (ROW1/ROW2)
-            if not (row.find('td', class_='ROW1') or row.find('td', class_='ROW2')):
-                continue
-            cells = row.find_all('td')
-            if not cells:
-                continue
-            # Use only the last N headers for mapping
-            n = len(cells)
-            used_headers = headers[-n:] if len(headers) >= n else [f'col{i}' for i in range(n)]
-            record = {}
-            has_data = False  # Track if this record has any meaningful data
-            
-            for i, cell in enumerate(cells):
-                a = cell.find('a')
-                if a and a.get_text(strip=True):
-                    text = a.get_text(separator=' ', strip=True)
-                else:
-                    text = cell.get_text(separator=' ', strip=True)
-                text = text.replace('\xa0', '').strip()
-                record[used_headers[i] if i < len(used_headers) else f'col{i}'] = text
-                
-                # Check if this cell has meaningful data (not empty or just whitespace)
-                if text and text.strip():
-                    has_data = True
-            
+        # Hash of each added record's (width, values) -> indexes into results, to skip duplicates.
+        # Only the int hashes are kept; the rare hash collision is settled by comparing with the stored records.
+        seen_records = {}
+        extractors = {}  # Record builder per row width, created from the first row of that width
+
+        for texts in data_texts:
+            n = len(texts)
+            extract = extractors.get(n)
+            if extract is None:
+                # Use only the last N headers for mapping
+                used_headers = headers[-n:] if len(headers) >= n else [f'col{i}' for i in range(n)]
+                extract = extractors[n] = _make_row_extractor(used_headers)
+
             # Only add records that have actual data
-            if has_data:
-                # Create a unique key for this record to avoid duplicates
-                record_key = tuple(sorted(record.items()))
-                if record_key not in seen_records:
-                    seen_records.add(record_key)
+            record = extract(texts)
+            if record is not None:
+                # Key on the row width and the cell values in column order (headers are fixed per width, no sort)
+                record_hash = hash((n, *record.values()))
+                same_hash = seen_records.get(record_hash)
+                if same_hash is None:
+                    seen_records[record_hash] = [len(results)]
                     results.append(record)
-            
-        print(f"Parsed {len(results)} records")
+                elif all(results[j] != record for j in same_hash):
+                    same_hash.append(len(results))
+                    results.append(record)
+
+        crm_logger.debug(f"Parsed {len(results)} records")
         return results
 
+def _has_class(name):
+    """XPath predicate matching elements whose class attribute contains the exact class token"""
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+# XPath queries used by _parse_results, compiled once at import instead of on every result page.
+# Data rows are the ones containing a ROW1/ROW2 cell. Only a row's own cells count - cells of a nested table are
+# read with that table's rows.
+_IS_DATA_ROW = etree.XPath(f"boolean(td[{_has_class('ROW1')} or {_has_class('ROW2')}])")
+_IS_HEADER_ROW = etree.XPath(f"boolean(td[{_has_class('GRIDHEAD')}])")
+_FIND_HEADER_CELLS = etree.XPath("td|th")
+_FIND_CELLS = etree.XPath("td")
+
+_STRIP_NBSP = {0xa0: None}
+
+def _make_row_extractor(used_headers):
+    """Record builder specialised for one row shape: the column headers are bound once, empty rows give None"""
+    def extract(texts):
+        if not any(texts):
+            return None
+        return dict(zip(used_headers, texts))
+    return extract
+
+def _cell_text(cell):
+    """Text of a table cell, preferring the text of its first link (as shown in the CRM grid).
+    Text nodes are joined with a space (so <br> and inline tags don't glue words together), non-breaking spaces
+    are dropped and whitespace runs collapsed to single spaces."""
+    link = cell.find('.//a')
+    if link is not None:
+        link_text = ' '.join(' '.join(link.itertext()).translate(_STRIP_NBSP).split())
+        if link_text:
+            return link_text
+    return ' '.join(' '.join(cell.itertext()).translate(_STRIP_NBSP).split())
+
+class CRMSessionManager:
+    """Thread-safe pool of logged-in CRM browsers shared by every request.
+    Browsers are kept between runs so later uploads skip Chrome startup and the whole login sequence.
+    Headless and visible browsers are pooled separately, so a run always gets the mode it asked for."""
+
+    def __init__(self, idle_timeout=DRIVER_IDLE_TIMEOUT, max_idle=CRM_MAX_IDLE_SESSIONS):
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle
+        self._lock = threading.Lock()
+        self._idle_drivers = {}  # headless -> list of (driver, last_used) tuples
+        self._janitor = None
+
+    def take_driver(self, headless=True):
+        """Pop the most recently used idle browser of the given mode, or None if there is none"""
+        with self._lock:
+            idle = self._idle_drivers.get(headless)
+            if not idle:
+                return None
+            driver, _ = idle.pop()
+            return driver
+
+    def put_driver(self, driver, headless=True):
+        """Return a logged-in browser to the pool. If that mode already has max_idle browsers waiting,
+        the longest-idle one is quit to make room"""
+        with self._lock:
+            idle = self._idle_drivers.setdefault(headless, [])
+            idle.append((driver, time.time()))
+            surplus = [driver for driver, _ in idle[:-self.max_idle]] if len(idle) > self.max_idle else []
+            del idle[:len(surplus)]
+            if self._janitor is None:
+                self._janitor = threading.Thread(target=self._janitor_loop, name="crm-session-janitor", daemon=True)
+                self._janitor.start()
+        for driver in surplus:
+            crm_logger.info("🧹 Closing surplus pooled browser")
+            _quit_driver(driver)
+
+    def acquire(self, headless=True):
+        """Return a logged-in CRMAutoLogin session, or None if login failed"""
+        session = CRMAutoLogin(headless=headless)
+        return session if session.start_session() else None
+
+    def release(self, session):
+        """Give a session's browser back to the pool"""
+        session.release_session()
+
+    def prepare(self):
+        """Make sure a logged-in browser is waiting in the pool (logging one in if needed)"""
+        session = self.acquire()
+        if session:
+            self.release(session)
+        return session is not None
+
+    def warm_up(self, count=CRM_WARM_SESSIONS):
+        """Log in `count` browsers in the background so the first uploads find them ready"""
+        for i in range(count):
+            threading.Thread(target=self.prepare, name=f"crm-warm-up-{i + 1}", daemon=True).start()
+
+    def shutdown(self):
+        """Quit every pooled browser so no Chrome processes outlive the app"""
+        with self._lock:
+            drivers = [driver for idle in self._idle_drivers.values() for driver, _ in idle]
+            self._idle_drivers = {}
+        for driver in drivers:
+            _quit_driver(driver)
+
+    def _janitor_loop(self):
+        """Quit pooled browsers that have been idle for longer than idle_timeout"""
+        while True:
+            time.sleep(60)
+            now = time.time()
+            with self._lock:
+                expired = []
+                for headless, idle in self._idle_drivers.items():
+                    expired.extend(driver for driver, last_used in idle if now - last_used > self.idle_timeout)
+                    self._idle_drivers[headless] = [(driver, last_used) for driver, last_used in idle
+                                                    if now - last_used <= self.idle_timeout]
+            for driver in expired:
+                crm_logger.info("🧹 Closing idle pooled browser")
+                _quit_driver(driver)
+
+CRM_SESSIONS = CRMSessionManager()
+atexit.register(CRM_SESSIONS.shutdown)
+
 # ===============================
 # WEB APPLICATION ROUTES
 # ===============================
 
+_background_tasks_lock = threading.Lock()
+_background_tasks_started = False
+
+@app.before_request
+def start_background_tasks():
+    """On the first request, create the file metadata table, start logging in the shared CRM browser pool and start
+    the uploads janitor. Done here rather than at import, so only the serving process runs them and merely importing
+    the module starts nothing and writes nothing."""
+    global _background_tasks_started
+    with _background_tasks_lock:
+        if _background_tasks_started:
+            return
+        # Inside the lock, so concurrent first requests wait until the table exists
+        _init_file_meta_db()
+        _background_tasks_started = True
+    CRM_SESSIONS.warm_up()
+    threading.Thread(target=_upload_janitor, name='upload-janitor', daemon=True).start()
+
+# Uploads are processed in the background so the upload request returns at once and the browser polls
+# /status/<job_id>, instead of an HTTP worker being held for the whole OCR + CRM + PDF pipeline
+JOB_EXECUTOR = ThreadPoolExecutor(max_workers=4 * (os.cpu_count() or 1), thread_name_prefix='upload-job')
+JOB_RETENTION = 60 * 60  # seconds a finished job's result stays available
+JOBS = {}  # job id -> {'future', 'created', 'progress', 'message', 'file_path'}
+_jobs_lock = threading.Lock()
+
+def _submit_job(file_path, filename, file_bytes=None):
+    """Start processing an upload in the background and return its job id. Expired finished jobs are dropped."""
+    job_id = secrets.token_hex(16)
+    job = {'future': None, 'created': time.time(), 'progress': 10, 'message': 'Extracting text from document...',
+           'file_path': file_path}
+
+    def report(progress, message):
+        job['progress'], job['message'] = progress, message
+
+    with _jobs_lock:
+        now = time.time()
+        for expired_id in [jid for jid, j in JOBS.items() if j['future'].done() and now - j['created'] > JOB_RETENTION]:
+            del JOBS[expired_id]
+        job['future'] = JOB_EXECUTOR.submit(_process_upload, file_path, filename, file_bytes, report)
+        JOBS[job_id] = job
+    return job_id
+
+def _process_upload(file_path, filename, file_bytes, report):
+    """Run OCR, Grok parsing, the CRM search and the annotated PDF for one saved upload.
+    Returns the result.html context plus the (message, category) pairs to flash when the result is shown."""
+    messages = []
+
+    # Log a CRM browser in while OCR runs, so the search can start as soon as the invoices are known
+    crm_prep_executor = ThreadPoolExecutor(max_workers=1)
+    crm_ready = crm_prep_executor.submit(CRM_SESSIONS.prepare)
+    crm_prep_executor.shutdown(wait=False)
+
+    # Extract invoices (can be multiple from PDF with proper page mapping)
+    if file_bytes is not None:
+        all_invoice_numbers, parsed_info_list, invoice_to_page_mapping = extract_invoice_from_bytes(file_bytes, filename)
+    else:
+        all_invoice_numbers, parsed_info_list, invoice_to_page_mapping = extract_invoice(file_path)
+    if not parsed_info_list:
+        messages.append(('No information extracted from the file.', 'danger'))
+        return {'records': parsed_info_list, 'all_crm_rows': [], 'logs': "", 'annotated_pdf': None, 'messages': messages}
+
+    # Filter out None invoice numbers for CRM processing
+    valid_invoices = [inv for inv in all_invoice_numbers if inv is not None]
+    messages.append((f'Extracted {len(parsed_info_list)} page(s) with {len(valid_invoices)} invoice(s). Launching CRM automation...', 'success'))
+    report(50, 'Searching CRM database...')
+
+    # Initialize CRM automation directly (no subprocess)
+    try:
+        crm_ready.result()  # usually already finished - OCR + Grok take longer than login
+        logger.info("🚀 Starting integrated CRM automation...")
+        crm = CRMAutoLogin(
+            headless=True,
+            invoice_numbers=all_invoice_numbers,  # Include all invoice numbers (including None)
+            invoice_to_page_mapping=invoice_to_page_mapping,  # Pass the mapping
+            return_json=True,
+            no_interactive=True,
+            web_output=True
+        )
+        
+        success, all_crm_rows = crm.run()
+        
+        # Ensure all pages are represented, even if no results found
+        all_crm_rows = ensure_all_pages_represented(all_crm_rows, parsed_info_list, invoice_to_page_mapping)
+        
+        if success:
+            if all_crm_rows:
+                messages.append((f'CRM automation completed! Found {len(all_crm_rows)} total records.', 'success'))
+            else:
+                messages.append(('CRM automation completed but no records found.', 'warning'))
+        else:
+            messages.append(('CRM automation failed. Check logs for details.', 'danger'))
+            all_crm_rows = []
+            
+        # Since we're running directly, logs are printed to console
+        combined_logs = "CRM automation completed. Check terminal for detailed logs."
+        
+    except Exception as e:
+        messages.append((f'CRM automation error: {str(e)}', 'danger'))
+        all_crm_rows = []
+        combined_logs = f"ERROR: {str(e)}"
+
+    # Generate annotated PDF if original file was a PDF and we have results
+    report(90, 'Generating results...')
+    annotated_pdf_filename = None
+    if is_pdf_file(file_path) and (all_crm_rows or parsed_info_list):
+        try:
+            annotated_pdf_filename = f"annotated_{secrets.token_hex(8)}_{filename}"
+            annotated_pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], annotated_pdf_filename)
+            
+            success = create_annotated_pdf(file_path, parsed_info_list, all_crm_rows, annotated_pdf_path, invoice_to_page_mapping, 6, 'auto')
+            if success:
+                set_download_name(annotated_pdf_filename, f"results_{get_download_name(filename) or filename}")
+                messages.append(('Annotated PDF generated successfully!', 'success'))
+            else:
+                annotated_pdf_filename = None
+                messages.append(('Failed to generate annotated PDF.', 'warning'))
+        except Exception as e:
+            logger.error(f"❌ Error generating annotated PDF: {e}")
+            annotated_pdf_filename = None
+            messages.append((f'Error generating annotated PDF: {str(e)}', 'warning'))
+
+    messages.append((f'Processing completed! Total CRM records found: {len(all_crm_rows)}', 'info'))
+    return {'records': parsed_info_list, 'all_crm_rows': all_crm_rows, 'logs': combined_logs,
+            'annotated_pdf': annotated_pdf_filename, 'messages': messages}
+
+# Most recent uploaded PDF per browser session, which /generate_annotated_pdf re-annotates
+LATEST_PDF = {}  # session id -> file path
+
+# Download name of every uploaded PDF and generated PDF, recorded when the file is written so serve_pdf does not
+# have to parse it back out of the <prefix>_<hex>_<name> file name. SQLite so all server processes share it.
+FILE_META_DB = os.path.join(UPLOAD_FOLDER, '.meta.sqlite3')
+
+def _file_meta_connect():
+    return closing(sqlite3.connect(FILE_META_DB, timeout=10))
+
+def _init_file_meta_db():
+    """Create the file metadata table if it doesn't exist yet"""
+    with _file_meta_connect() as db, db:
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('CREATE TABLE IF NOT EXISTS file_meta (filename TEXT PRIMARY KEY, download_name TEXT NOT NULL, mtime REAL NOT NULL)')
+
+def set_download_name(filename, download_name):
+    """Record the name a stored file should be downloaded as"""
+    with _file_meta_connect() as db, db:
+        db.execute('INSERT OR REPLACE INTO file_meta VALUES (?, ?, ?)', (filename, download_name, time.time()))
+
+def get_download_name(filename):
+    """Download name recorded for a stored file, or None"""
+    with _file_meta_connect() as db:
+        row = db.execute('SELECT download_name FROM file_meta WHERE filename = ?', (filename,)).fetchone()
+    return row[0] if row else None
+
+# Uploads and generated PDFs are deleted once they are this old, so the uploads folder doesn't grow forever
+UPLOAD_RETENTION = int(os.getenv('UPLOAD_RETENTION_HOURS', '24')) * 60 * 60  # seconds
+UPLOAD_CLEANUP_INTERVAL = 60 * 60  # seconds
+
+def cleanup_uploads(max_age=UPLOAD_RETENTION):
+    """Delete stored files older than max_age seconds, except uploads that a running job is still working on.
+    Returns the number of files deleted"""
+    with _jobs_lock:
+        in_use = {job['file_path'] for job in JOBS.values() if not job['future'].done()}
+    cutoff = time.time() - max_age
+    removed = []
+    with os.scandir(UPLOAD_FOLDER) as entries:
+        for entry in entries:
+            # dot files are the app's own (the file metadata database)
+            if entry.name.startswith('.') or not entry.is_file() or entry.path in in_use:
+                continue
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.unlink(entry.path)
+                    removed.append(entry.name)
+            except FileNotFoundError:
+                pass
+    if removed:
+        removed_paths = {os.path.join(UPLOAD_FOLDER, name) for name in removed}
+        for sid, path in list(LATEST_PDF.items()):
+            if path in removed_paths:
+                LATEST_PDF.pop(sid, None)
+        with _file_meta_connect() as db, db:
+            db.executemany('DELETE FROM file_meta WHERE filename = ?', [(name,) for name in removed])
+        logger.info(f"🧹 Deleted {len(removed)} stored file(s) older than {max_age // 3600}h")
+    return len(removed)
+
+def _upload_janitor():
+    while True:
+        time.sleep(UPLOAD_CLEANUP_INTERVAL)
+        try:
+            cleanup_uploads()
+            # The OCR cache is kept as long as the uploads it was made from
+            prune_ocr_cache(UPLOAD_RETENTION)
+        except Exception as e:
+            logger.error(f"❌ Error cleaning up uploads: {e}")
+
+@app.before_request
+def ensure_session_id():
+    """Give every browser session an id, used to find its own latest upload"""
+    if 'sid' not in session:
+        session['sid'] = secrets.token_hex(16)
+
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
-        if 'file' not in request.files:
+        # Large uploads are streamed to disk as they arrive; smaller ones go through request.files as usual
+        streamed = None
+        if StreamingFormDataParser is not None and (request.content_length or 0) >= IN_MEMORY_UPLOAD_LIMIT:
+            streamed = _stream_upload()
+            upload_filename = streamed.multipart_filename
+        else:
+            file = request.files.get('file')
+            upload_filename = file.filename if file is not None else None
+        if upload_filename is None:
             flash('No file part', 'warning')
             return redirect(request.url)
-        file = request.files['file']
-        if file.filename == '':
+        if upload_filename == '':
             flash('No selected file', 'warning')
             return redirect(request.url)
-        if file and allowed_file(file.filename):
-            filename = f"{uuid.uuid4().hex}_{file.filename}"
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(file_path)
-            
-            # Extract invoices (can be multiple from PDF with proper page mapping)
-            all_invoice_numbers, parsed_info_list, invoice_to_page_mapping = extract_invoice(file_path)
-            if not parsed_info_list:
-                flash('No information extracted from the file.', 'danger')
-                return render_template('result.html', records=parsed_info_list, all_crm_rows=[], logs="")
+        if allowed_file(upload_filename):
+            if streamed is not None:
+                filename = streamed.upload_name
+                file_path = streamed.filename
+                upload_size = os.path.getsize(file_path)
             else:
-                # Filter out None invoice numbers for CRM processing
-                valid_invoices = [inv for inv in all_invoice_numbers if inv is not None]
-                flash(f'Extracted {len(parsed_info_list)} page(s) with {len(valid_invoices)} invoice(s). Launching CRM automation...', 'success')
-                
-                # Initialize CRM automation directly (no subprocess)
-                try:
-                    print("🚀 Starting integrated CRM automation...")
-                    crm = CRMAutoLogin(
-                        headless=True,
-                        invoice_numbers=all_invoice_numbers,  # Include all invoice numbers (including None)
-                        invoice_to_page_mapping=invoice_to_page_mapping,  # Pass the mapping
-                        return_json=True,
-                        no_interactive=True,
-                        web_output=True
-                    )
-                    
-                    success, all_crm_rows = crm.run()
-                    
-                    # Ensure all pages are represented, even if no results found
-                    all_crm_rows = ensure_all_pages_represented(all_crm_rows, parsed_info_list, invoice_to_page_mapping)
-                    
-                    if success:
-                        if all_crm_rows:
-                            flash(f'CRM automation completed! Found {len(all_crm_rows)} total records.', 'success')
-                        else:
-                            flash('CRM automation completed but no records found.', 'warning')
-                    else:
-                        flash('CRM automation failed. Check logs for details.', 'danger')
-                        all_crm_rows = []
-                        
-                    # Since we're running directly, logs are printed to console
-                    combined_logs = "CRM automation completed. Check terminal for detailed logs."
-                    
-                except Exception as e:
-                    flash(f'CRM automation error: {str(e)}', 'danger')
-                    all_crm_rows = []
-                    combined_logs = f"ERROR: {str(e)}"
-
-                # Generate annotated PDF if original file was a PDF and we have results
-                annotated_pdf_filename = None
-                if is_pdf_file(file_path) and (all_crm_rows or parsed_info_list):
-                    try:
-                        annotated_pdf_filename = f"annotated_{uuid.uuid4().hex}_{filename}"
-                        annotated_pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], annotated_pdf_filename)
-                        
-                        success = create_annotated_pdf(file_path, parsed_info_list, all_crm_rows, annotated_pdf_path, invoice_to_page_mapping, 6, 'auto')
-                        if success:
-                            flash('Annotated PDF generated successfully!', 'success')
-                        else:
-                            annotated_pdf_filename = None
-                            flash('Failed to generate annotated PDF.', 'warning')
-                    except Exception as e:
-                        print(f"❌ Error generating annotated PDF: {e}")
-                        annotated_pdf_filename = None
-                        flash(f'Error generating annotated PDF: {str(e)}', 'warning')
-
-                flash(f'Processing completed! Total CRM records found: {len(all_crm_rows)}', 'info')
-                return render_template('result.html', 
-                                     records=parsed_info_list, 
-                                     all_crm_rows=all_crm_rows, 
-                                     logs=combined_logs,
-                                     annotated_pdf=annotated_pdf_filename)
+                filename = f"{secrets.token_hex(8)}_{file.filename}"
+                file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+                file.stream.seek(0, os.SEEK_END)
+                upload_size = file.stream.tell()
+                file.stream.seek(0)
+
+            # The upload has to be read or saved here - the request's stream is gone once the job runs
+            file_bytes = None
+            if streamed is None and upload_size < IN_MEMORY_UPLOAD_LIMIT:
+                file_bytes = file.read()
+                # PDFs are still written out because the annotated copy is made from the original file
+                if is_pdf_file(file_path):
+                    with open(file_path, 'wb') as f:
+                        f.write(file_bytes)
+            elif streamed is None:
+                file.save(file_path)
+            if is_pdf_file(file_path):
+                # PDFs are always written out; their name is needed for the annotated copies' download names
+                set_download_name(filename, upload_filename)
+                LATEST_PDF[session['sid']] = file_path
+
+            job_id = _submit_job(file_path, filename, file_bytes)
+            return render_template('progress.html', job_id=job_id), 202
         else:
             flash('File type not allowed. Please upload an image.', 'danger')
             return redirect(request.url)
     return render_template('index.html')
 
+@app.route('/status/<job_id>')
+def job_status(job_id):
+    """Progress of a background upload job, polled by the progress page"""
+    job = JOBS.get(job_id)
+    if job is None:
+        return jsonify({'state': 'unknown'}), 404
+    future = job['future']
+    if not future.done():
+        return jsonify({'state': 'running', 'progress': job['progress'], 'message': job['message']})
+    if future.exception() is not None:
+        return jsonify({'state': 'failed', 'error': str(future.exception())})
+    return jsonify({'state': 'done', 'progress': 100, 'message': 'Done'})
+
+@app.route('/result/<job_id>')
+def job_result(job_id):
+    """Show the results of a finished background upload job"""
+    job = JOBS.get(job_id)
+    if job is None:
+        flash('Unknown or expired job. Please upload the file again.', 'warning')
+        return redirect(url_for('index'))
+    future = job['future']
+    if not future.done():
+        return render_template('progress.html', job_id=job_id), 202
+    try:
+        result = future.result()
+    except Exception as e:
+        logger.error(f"❌ Error processing upload: {e}")
+        flash(f'Error processing file: {str(e)}', 'danger')
+        return redirect(url_for('index'))
+
+    for message, category in result['messages']:
+        flash(message, category)
+    return render_template('result.html', 
+                         records=result['records'], 
+                         all_crm_rows=result['all_crm_rows'], 
+                         logs=result['logs'],
+                         annotated_pdf=result['annotated_pdf'])
+
 
 @app.route('/serve_pdf/<filename>')
 def serve_pdf(filename):
     """Serve generated PDF files for download"""
     try:
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        if os.path.exists(file_path) and ('annotated_' in filename or 'updated_annotated_' in filename):
-            # Extract the original filename for download
-            if filename.startswith('updated_annotated_'):
-                # For updated PDFs: updated_annotated_{uuid}_{original_filename}
-                parts = filename.split('_', 3)
-                if len(parts) >= 4:
-                    download_name = f"updated_results_{parts[3]}"
-                else:
-                    download_name = f"updated_results_{filename}"
-            elif filename.startswith('annotated_'):
-                # For original annotated PDFs: annotated_{uuid}_{original_filename}
-                parts = filename.split('_', 2)
-                if len(parts) >= 3:
-                    download_name = f"results_{parts[2]}"
-                else:
-                    download_name = f"results_{filename}"
-            else:
-                download_name = filename
-            
-            return send_file(file_path, as_attachment=True, download_name=download_name)
+        if 'annotated_' in filename or 'updated_annotated_' in filename:
+            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+            download_name = get_download_name(filename) or filename
+            # conditional: ETag/Last-Modified revalidation and Range requests, so interrupted downloads can resume.
+            # send_file stats the file itself, so a missing file is caught below rather than checked for first
+            response = send_file(file_path, as_attachment=True, download_name=download_name, conditional=True, etag=True)
+            # Generated PDFs never change (every version gets a new name) and are already Flate-compressed inside, so
+            # let the browser keep them and tell proxies not to gzip them again
+            response.headers['Cache-Control'] = 'private, max-age=3600, no-transform'
+            return response
         else:
             return jsonify({'error': 'File not found'}), 404
+    except FileNotFoundError:
+        return jsonify({'error': 'File not found'}), 404
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -1562,61 +2270,45 @@ def generate_annotated_pdf():
         if not table_data:
             return jsonify({'success': False, 'error': 'No table data provided'}), 400
         
-        # We need to find the original PDF file to annotate
-        # For now, we'll use the most recent PDF file in uploads
-        pdf_files = [f for f in os.listdir(app.config['UPLOAD_FOLDER']) 
-                    if f.lower().endswith('.pdf') and not f.startswith('annotated_')]
-        
-        if not pdf_files:
+        # Annotate the PDF this browser session uploaded last (not whichever upload is newest on disk)
+        original_pdf_path = LATEST_PDF.get(session.get('sid'))
+        if not original_pdf_path or not os.path.exists(original_pdf_path):
             return jsonify({'success': False, 'error': 'No original PDF file found'}), 400
-        
-        # Use the most recent PDF file
-        pdf_files.sort(key=lambda f: os.path.getmtime(os.path.join(app.config['UPLOAD_FOLDER'], f)), reverse=True)
-        original_pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], pdf_files[0])
+        original_pdf_name = os.path.basename(original_pdf_path)
         
         # Create filename for the new annotated PDF
-        base_filename = os.path.splitext(pdf_files[0])[0]  # Remove extension
-        annotated_filename = f"updated_annotated_{uuid.uuid4().hex}_{base_filename}.pdf"
+        base_filename = os.path.splitext(original_pdf_name)[0]  # Remove extension
+        annotated_filename = f"updated_annotated_{secrets.token_hex(8)}_{base_filename}.pdf"
         annotated_pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], annotated_filename)
         
-        print(f"📝 Creating updated annotated PDF:")
-        print(f"   Original PDF: {pdf_files[0]}")
-        print(f"   New filename: {annotated_filename}")
-        print(f"   Output path: {annotated_pdf_path}")
+        logger.info(f"📝 Creating updated annotated PDF:")
+        logger.info(f"   Original PDF: {original_pdf_name}")
+        logger.info(f"   New filename: {annotated_filename}")
+        logger.info(f"   Output path: {annotated_pdf_path}")
         
         # Group table data by page index
         crm_by_page = {}
-        parsed_info_list = []
-        
         for row in table_data:
-            page_idx = row.get('_page_index', 0)
-            if page_idx not in crm_by_page:
-                crm_by_page[page_idx] = []
-            crm_by_page[page_idx].append(row)
-            
-            # Create parsed info entry if not exists
-            while len(parsed_info_list) <= page_idx:
-                parsed_info_list.append({})
+            crm_by_page.setdefault(row.get('_page_index', 0), []).append(row)
+        
+        # One parsed info entry per page, up to the last page that has rows
+        parsed_info_list = [{} for _ in range(max(crm_by_page, default=-1) + 1)]
         
         # Convert grouped data back to list format for the PDF function
-        all_crm_rows = []
-        for page_idx in sorted(crm_by_page.keys()):
-            all_crm_rows.extend(crm_by_page[page_idx])
+        all_crm_rows = [row for page_idx in sorted(crm_by_page) for row in crm_by_page[page_idx]]
         
         # Create invoice to page mapping (simplified)
-        invoice_to_page_mapping = []
-        for page_idx in range(len(parsed_info_list)):
-            invoice_to_page_mapping.append({
-                'page_index': page_idx,
-                'invoice': f"Page {page_idx + 1}",
-                'page_info': parsed_info_list[page_idx] if page_idx < len(parsed_info_list) else {},
-                'original_invoice_string': f"Page {page_idx + 1}"
-            })
+        invoice_to_page_mapping = [{
+            'page_index': page_idx,
+            'invoice': f"Page {page_idx + 1}",
+            'page_info': page_info,
+            'original_invoice_string': f"Page {page_idx + 1}"
+        } for page_idx, page_info in enumerate(parsed_info_list)]
         
         # Generate the annotated PDF
-        print(f"🚀 Calling create_annotated_pdf function...")
-        print(f"   📝 Using font size: {font_size}px")
-        print(f"   🔤 Using font type: {font_type}")
+        logger.info(f"🚀 Calling create_annotated_pdf function...")
+        logger.info(f"   📝 Using font size: {font_size}px")
+        logger.info(f"   🔤 Using font type: {font_type}")
         success = create_annotated_pdf(
             original_pdf_path, 
             parsed_info_list, 
@@ -1628,23 +2320,29 @@ def generate_annotated_pdf():
         )
         
         # Verify the file was created and is valid
-        if success and os.path.exists(annotated_pdf_path):
-            file_size = os.path.getsize(annotated_pdf_path)
-            print(f"✅ PDF created successfully:")
-            print(f"   File path: {annotated_pdf_path}")
-            print(f"   File size: {file_size} bytes")
+        try:
+            file_size = os.stat(annotated_pdf_path).st_size
+        except FileNotFoundError:
+            file_size = None
+        if success and file_size is not None:
+            logger.info(f"✅ PDF created successfully:")
+            logger.info(f"   File path: {annotated_pdf_path}")
+            logger.info(f"   File size: {file_size} bytes")
             
-            # Basic PDF validation - check if it starts with PDF header
-            try:
-                with open(annotated_pdf_path, 'rb') as f:
-                    header = f.read(4)
-                    if header == b'%PDF':
-                        print("✅ PDF header validation passed")
-                    else:
-                        print(f"⚠️ PDF header validation failed: {header}")
-            except Exception as e:
-                print(f"⚠️ PDF validation error: {e}")
+            # Basic PDF validation - check if it starts with PDF header (debug only, the writer already reported success)
+            if app.debug:
+                try:
+                    with open(annotated_pdf_path, 'rb') as f:
+                        header = f.read(4)
+                        if header == b'%PDF':
+                            logger.info("✅ PDF header validation passed")
+                        else:
+                            logger.warning(f"⚠️ PDF header validation failed: {header}")
+                except Exception as e:
+                    logger.warning(f"⚠️ PDF validation error: {e}")
             
+            original_name = get_download_name(original_pdf_name) or original_pdf_name
+            set_download_name(annotated_filename, f"updated_results_{os.path.splitext(original_name)[0]}.pdf")
             return jsonify({
                 'success': True, 
                 'filename': annotated_filename,
@@ -1654,15 +2352,21 @@ def generate_annotated_pdf():
             error_msg = 'Failed to generate annotated PDF'
             if not success:
                 error_msg += ' - PDF creation function returned False'
-            if not os.path.exists(annotated_pdf_path):
+            if file_size is None:
                 error_msg += f' - Output file does not exist: {annotated_pdf_path}'
             
-            print(f"❌ {error_msg}")
+            logger.error(f"❌ {error_msg}")
             return jsonify({'success': False, 'error': error_msg}), 500
             
     except Exception as e:
-        print(f"❌ Error in generate_annotated_pdf route: {e}")
+        logger.error(f"❌ Error in generate_annotated_pdf route: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+# Compile the templates at startup, so the first requests don't pay for it
+for _template in ('base.html', 'index.html', 'progress.html', 'result.html'):
+    app.jinja_env.get_template(_template)
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5002, debug=True) 
\ No newline at end of file
+    # Development server only - run under gunicorn in production (see gunicorn.conf.py). FLASK_DEBUG=1 turns on the
+    # debugger and reloader.
+    app.run(host='0.0.0.0', port=5002, debug=os.getenv('FLASK_DEBUG') == '1') 
\ No newline at end of file